@@ -0,0 +1,179 @@
+'''Static analysis of problem instances.'''
+from bisect import bisect_right
+import evaluator
+from instance import Instance
+from evaluator import T_EMPTY_TO_BF, AT_BF, AT_DESULF, T_DESULF_TO_CONVERTER, \
+    AT_CONVERTER, T_CONVERTER_TO_EMPTY
+
+# States whose time slots can be estimated before solving, by report
+# name. Full buffer and the transits around it depend on which BF
+# serves which converter, so they are left out.
+_FIXED_STATES = [
+    ('empty_buffer_to_bf', T_EMPTY_TO_BF),
+    ('bf', AT_BF),
+    ('desulf', AT_DESULF),
+    ('desulf_to_converter', T_DESULF_TO_CONVERTER),
+    ('converter', AT_CONVERTER),
+    ('converter_to_empty_buffer', T_CONVERTER_TO_EMPTY)
+]
+
+
+_CONGESTION_NOTE = (
+    'Peaks are lower bound estimates from the slots every solution '
+    'occupies. BF slots are exact, converter slots assume the minimum '
+    'early arrival and desulf the shortest feasible desulf. Full buffer '
+    'and its transits depend on the BF to converter pairing and are not '
+    'counted, neither in the states nor in the torpedoes.')
+
+
+def _get_sulf_buckets(instance: Instance):
+    '''Returns sorted BF times for each sulfur level.'''
+    buckets = dict()
+    for bf in instance.bf_schedules:
+        buckets.setdefault(bf.sulf_level, []).append(bf.time)
+    for times in buckets.values():
+        times.sort()
+    return buckets
+
+
+def calculate_domains(instance: Instance):
+    '''Calculates per converter the number of feasible and pullable
+    schedules and the shortest feasible desulf duration, using the same
+    rules as Instance.get_distance without building the matrix.
+    '''
+    buckets = _get_sulf_buckets(instance)
+    overhead = instance.dur_bf + instance.tt_bf_to_full_buffer \
+        + instance.tt_full_buffer_to_desulf + instance.tt_desulf_to_converter
+    domains = []
+    for converter in instance.converter_schedules:
+        feasible = 0
+        pullable = 0
+        min_desulf = None
+        for sulf_level, times in buckets.items():
+            desulf = max(0, sulf_level - converter.max_sulf_level) \
+                * instance.dur_desulf
+            latest = converter.time - overhead - desulf
+            count = bisect_right(times, latest)
+            feasible += count
+            pullable += bisect_right(times, latest - converter.min_early_arrival)
+            if count > 0 and (min_desulf is None or desulf < min_desulf):
+                min_desulf = desulf
+        domains.append((feasible, pullable, min_desulf))
+    return domains
+
+
+def find_pull_clusters(instance: Instance):
+    '''Groups consecutive converters that have to arrive early
+    together with the converter that causes the pull.
+    '''
+    clusters = []
+    current = None
+    for converter in instance.converter_schedules:
+        if current is not None:
+            current.append(converter)
+        if converter.min_early_arrival > 0:
+            if current is None:
+                current = [converter]
+        elif current is not None:
+            clusters.append(current)
+            current = None
+    if current is not None:
+        clusters.append(current)
+    return [{
+        'converters': [converter.converter_id for converter in cluster],
+        'start': cluster[0].time,
+        'end': cluster[-1].time,
+        'min_early_arrival': [converter.min_early_arrival for converter in cluster]
+    } for cluster in clusters]
+
+
+def _get_fixed_intervals(instance: Instance, domains):
+    '''Returns estimated (state, start, end) intervals that every
+    solution occupies. BF intervals are exact. Converter intervals
+    assume the minimum early arrival of pullable schedules, which
+    resolve_conflicts may still extend, and desulf is only the
+    shortest feasible desulf before it, so both are lower bounds.
+    AT_FULL_BUFFER is not covered.
+    '''
+    intervals = []
+    for bf in instance.bf_schedules:
+        intervals.append(
+            (T_EMPTY_TO_BF, bf.time - instance.tt_empty_buffer_to_bf, bf.time))
+        intervals.append((AT_BF, bf.time, bf.time + instance.dur_bf))
+    for converter, (_, _, min_desulf) in zip(instance.converter_schedules, domains):
+        arrival = converter.time - converter.min_early_arrival
+        depart = converter.time + instance.dur_converter + converter.depart_delay
+        desulf_end = arrival - instance.tt_desulf_to_converter
+        intervals.append((AT_DESULF, desulf_end - (min_desulf or 0), desulf_end))
+        intervals.append((T_DESULF_TO_CONVERTER, desulf_end, arrival))
+        intervals.append((AT_CONVERTER, arrival, depart))
+        intervals.append((T_CONVERTER_TO_EMPTY, depart,
+                          depart + instance.tt_converter_to_empty_buffer))
+    return intervals
+
+
+def _sweep_bins(intervals, horizon, bins):
+    '''Returns the peak concurrency of the intervals in every time bin.'''
+    events = []
+    for start, end in intervals:
+        if end > start:
+            events.append((start, 1))
+            events.append((end, -1))
+    events.sort()
+    peaks = [0 for i in range(bins)]
+    count = 0
+    current_bin = 0
+    for time, delta in events:
+        time_bin = min(bins - 1, max(0, time * bins // horizon))
+        while current_bin < time_bin:
+            current_bin += 1
+            peaks[current_bin] = max(peaks[current_bin], count)
+        count += delta
+        peaks[time_bin] = max(peaks[time_bin], count)
+    return peaks
+
+
+def analyze_instance(instance: Instance, bins=50):
+    '''Builds a report on what makes an instance hard without solving it.
+    Runs in O((B + C) log B) for B blast furnace and C converter schedules.
+    '''
+    bf_count = len(instance.bf_schedules)
+    converter_count = len(instance.converter_schedules)
+    domains = calculate_domains(instance)
+    feasible = sum(domain[0] for domain in domains)
+    pullable = sum(domain[1] for domain in domains)
+
+    horizon = instance.get_latest_time() + 1
+    bins = max(1, min(bins, horizon))
+    max_states = evaluator.get_state_constraints(instance)
+    intervals = _get_fixed_intervals(instance, domains)
+    states = dict()
+    for name, state in _FIXED_STATES:
+        states[name] = {
+            'capacity': max_states[state],
+            'peaks': _sweep_bins([(start, end) for interval_state, start, end
+                                  in intervals if interval_state == state],
+                                 horizon, bins)
+        }
+    torpedoes = _sweep_bins([(start, end) for _, start, end in intervals],
+                            horizon, bins)
+
+    return {
+        'bf_count': bf_count,
+        'converter_count': converter_count,
+        'domain_sizes': [domain[0] for domain in domains],
+        'pullable_domain_sizes': [domain[1] for domain in domains],
+        'empty_domains': [converter_id for converter_id, domain
+                          in enumerate(domains) if domain[1] == 0],
+        'matrix_density': feasible / max(1, bf_count * converter_count),
+        'non_pullable_count': feasible - pullable,
+        'pull_clusters': find_pull_clusters(instance),
+        'min_desulf_time': sum(domain[2] or 0 for domain in domains),
+        'congestion': {
+            'note': _CONGESTION_NOTE,
+            'horizon': horizon,
+            'bin_width': horizon / bins,
+            'states': states,
+            'torpedoes': torpedoes
+        }
+    }
@@ -0,0 +1,320 @@
+'''Local solver service that keeps instances warm between requests.
+
+Requests and responses are JSON objects, one per line, sent over a Unix
+socket or a localhost TCP port. Each request has a command, an instance
+path and an optional id that is echoed back in the response:
+
+    {"id": 1, "command": "solve", "instance": "ins/instance01.ins"}
+    {"id": 2, "command": "print_solution", "instance": "ins/instance01.ins"}
+    {"id": 3, "command": "evaluate", "instance": "ins/instance01.ins",
+     "solution": "instance01.sol"}
+'''
+import os
+import json
+import stat
+import socket
+import asyncio
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+import evaluator
+import verifier
+from instance import Instance
+from solution import find_initial_solution, hill_climb, optimize
+
+_cache = OrderedDict()
+_instances = OrderedDict()
+_cache_size = 4
+
+
+class WarmInstance:
+    '''Keeps a parsed instance with its matrix and initial solution.'''
+
+    def __init__(self, instance: Instance):
+        self.instance = instance
+        self.solution, self.matrix = find_initial_solution(instance)
+        self.indices = [schedule_map.current_index
+                        for schedule_map in self.matrix]
+
+    def reset(self):
+        '''Returns a fresh copy of the initial solution and restores the
+        matrix to the state it had right after the initial solution.
+        '''
+        for schedule_map, index in zip(self.matrix, self.indices):
+            schedule_map.current_index = index
+        return list(self.solution)
+
+    def snapshot(self):
+        '''Saves the schedule fields that resolve_conflicts mutates.'''
+        return [(schedule, schedule.buffer_duration,
+                 schedule.converter_early_arrival)
+                for schedule in (schedule_map.get_current_schedule()
+                                 for schedule_map in self.matrix)
+                if schedule is not None]
+
+    @staticmethod
+    def restore(snapshot):
+        '''Restores schedule fields saved by snapshot.'''
+        for schedule, buffer_duration, converter_early_arrival in snapshot:
+            schedule.buffer_duration = buffer_duration
+            schedule.converter_early_arrival = converter_early_arrival
+
+    def optimize(self):
+        '''Optimizes a fresh copy of the initial solution. Returns the
+        solution, its timeline, the number of compound moves evaluated
+        and a snapshot to restore once the result has been read.
+        '''
+        instance, matrix = self.instance, self.matrix
+        solution = self.reset()
+        snapshot = []
+
+        def _phase(message, phase):
+            if phase == 'resolve_conflicts':
+                snapshot.extend(self.snapshot())
+
+        timeline = hill_climb(instance, solution, matrix)
+        try:
+            timeline, evaluated = optimize(instance, solution, matrix,
+                                           timeline, phase=_phase)
+        except Exception:
+            self.restore(snapshot)
+            raise
+        return solution, timeline, evaluated, snapshot
+
+
+def _init_worker(cache_size):
+    global _cache_size
+    _cache_size = cache_size
+
+
+def _get_key(path):
+    file_stat = os.stat(path)
+    return os.path.realpath(path), file_stat.st_mtime_ns, file_stat.st_size
+
+
+def _get_cached(cache, key, create):
+    '''Returns a cached value, creating it on a miss and
+    evicting the least recently used value when full.
+    '''
+    value = cache.get(key)
+    if value is not None:
+        cache.move_to_end(key)
+        return value, True
+    value = create(key)
+    cache[key] = value
+    while len(cache) > _cache_size:
+        cache.popitem(last=False)
+    return value, False
+
+
+def _parse_instance(key):
+    with open(key[0]) as file:
+        return Instance.parse(file.readlines())
+
+
+def _create_warm_instance(key):
+    return WarmInstance(_get_cached(_instances, key, _parse_instance)[0])
+
+
+def _get_instance(path):
+    '''Returns a cached parsed instance without solver setup.'''
+    return _get_cached(_instances, _get_key(path), _parse_instance)
+
+
+def _get_warm_instance(path):
+    '''Returns a cached warm instance, reusing its parsed instance.'''
+    return _get_cached(_cache, _get_key(path), _create_warm_instance)
+
+
+def solve_warm(entry: WarmInstance):
+    '''Optimizes a warm instance from its initial solution and
+    returns the result, leaving the entry ready for reuse.
+    '''
+    instance, matrix = entry.instance, entry.matrix
+    solution, timeline, evaluated, snapshot = entry.optimize()
+    try:
+        conflicts, torpedo_count = timeline.count_conflicts()
+        desulf_time = evaluator.calculate_desulf_time(solution, matrix)
+        total_time = evaluator.calculate_total_time(instance, solution, matrix)
+    finally:
+        entry.restore(snapshot)
+    cost = evaluator.evaluate_solution(instance, torpedo_count, desulf_time)
+    return {
+        'torpedo_count': torpedo_count,
+        'desulf_time': desulf_time,
+        'total_time': total_time,
+        'conflicts': conflicts,
+        'cost': cost,
+        'gain': evaluator.evaluate_gain(instance, cost),
+        'compound_moves': evaluated,
+        'solution': solution
+    }
+
+
+def _print_solution(entry, path):
+    instance, matrix = entry.instance, entry.matrix
+    solution, _, _, snapshot = entry.optimize()
+    try:
+        runs, torpedoes = evaluator.calculate_solution_runs(
+            instance, solution, matrix)
+    finally:
+        entry.restore(snapshot)
+    lines = [os.path.basename(path), 'TeamsID=',
+             'nbTorpedoes={}'.format(len(torpedoes)), '']
+    lines.extend(repr(run) for run in runs)
+    return {'text': ''.join(line + '\n' for line in lines)}
+
+
+def _evaluate(instance, solution_path):
+    with open(solution_path) as file:
+        torpedo_count, runs, errors = verifier.parse_solution(
+            file.readlines())
+    if len(errors) > 0:
+        return {'violations': errors, 'torpedo_count': torpedo_count,
+                'peak_torpedoes': 0, 'desulf_time': 0, 'cost': 0}
+    errors, peak_torpedoes, desulf_time, cost = verifier.verify_solution(
+        instance, torpedo_count, runs)
+    return {
+        'violations': errors,
+        'torpedo_count': torpedo_count,
+        'peak_torpedoes': peak_torpedoes,
+        'desulf_time': desulf_time,
+        'cost': cost
+    }
+
+
+def _handle(request):
+    '''Runs a request inside a worker process.'''
+    command = request.get('command')
+    path = request['instance']
+    if command == 'solve':
+        entry, cached = _get_warm_instance(path)
+        result = solve_warm(entry)
+    elif command == 'print_solution':
+        entry, cached = _get_warm_instance(path)
+        result = _print_solution(entry, path)
+    elif command == 'evaluate':
+        instance, cached = _get_instance(path)
+        result = _evaluate(instance, request['solution'])
+    else:
+        raise ValueError('Unknown command {}'.format(command))
+    result['cached'] = cached
+    return result
+
+
+def _remove_socket(path):
+    '''Removes a stale socket, refusing to remove any other file.'''
+    try:
+        mode = os.lstat(path).st_mode
+    except FileNotFoundError:
+        return
+    if not stat.S_ISSOCK(mode):
+        raise Exception('{} exists and is not a socket'.format(path))
+    os.unlink(path)
+
+
+class SolverService:
+    '''Dispatches requests to worker processes. Every instance is routed
+    to the same worker, so its parsed data stays warm in that worker.
+    '''
+
+    def __init__(self, workers=None, cache_size=4):
+        if workers is None:
+            workers = os.cpu_count() or 1
+        self.executors = [ProcessPoolExecutor(1, initializer=_init_worker,
+                                              initargs=(cache_size,))
+                          for i in range(workers)]
+
+    def _get_executor(self, path):
+        key = os.path.realpath(path)
+        return self.executors[hash(key) % len(self.executors)]
+
+    async def handle(self, request):
+        '''Run a request and return its response object.'''
+        response = {'id': request.get('id')}
+        try:
+            executor = self._get_executor(request['instance'])
+            loop = asyncio.get_running_loop()
+            response['result'] = await loop.run_in_executor(
+                executor, _handle, request)
+        except Exception as error:
+            response['error'] = '{}: {}'.format(type(error).__name__, error)
+        return response
+
+    async def _serve_client(self, reader, writer):
+        lock = asyncio.Lock()
+        tasks = set()
+
+        async def _respond(request):
+            response = await self.handle(request)
+            async with lock:
+                writer.write((json.dumps(response) + '\n').encode())
+                await writer.drain()
+
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    request = json.loads(line)
+                except ValueError as error:
+                    response = {'id': None,
+                                'error': 'Invalid JSON: {}'.format(error)}
+                    async with lock:
+                        writer.write((json.dumps(response) + '\n').encode())
+                        await writer.drain()
+                    continue
+                task = asyncio.ensure_future(_respond(request))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+            if tasks:
+                await asyncio.wait(tasks)
+        finally:
+            writer.close()
+
+    async def serve(self, address):
+        '''Serve on a Unix socket path or a localhost TCP port.'''
+        if isinstance(address, int):
+            server = await asyncio.start_server(
+                self._serve_client, '127.0.0.1', address)
+        else:
+            _remove_socket(address)
+            server = await asyncio.start_unix_server(
+                self._serve_client, address)
+        async with server:
+            await server.serve_forever()
+
+    def shutdown(self):
+        '''Stop all worker processes.'''
+        for executor in self.executors:
+            executor.shutdown()
+
+
+def parse_address(address):
+    '''Returns a port number for numeric addresses, else a socket path.'''
+    return int(address) if address.isdigit() else address
+
+
+def send_request(address, request):
+    '''Send one request to a running service and wait for its response.'''
+    address = parse_address(address) if isinstance(address, str) else address
+    if isinstance(address, int):
+        connection = socket.create_connection(('127.0.0.1', address))
+    else:
+        connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        connection.connect(address)
+    with connection, connection.makefile('rw') as stream:
+        stream.write(json.dumps(request) + '\n')
+        stream.flush()
+        return json.loads(stream.readline())
+
+
+def serve(address, workers=None, cache_size=4):
+    '''Run the service until interrupted.'''
+    service = SolverService(workers, cache_size)
+    try:
+        asyncio.run(service.serve(parse_address(address)))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        service.shutdown()
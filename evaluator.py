@@ -33,16 +33,6 @@ def calculate_total_time(instance: Instance, solution, matrix):
     return duration
 
 
-def calculate_torpedo_count(timeline, start=0, end=-1):
-    '''Calculate the maximum number of torpedoes in a timeline.'''
-    max_value = 0
-    if end == -1:
-        end = len(timeline)
-    for time in range(start, end):
-        max_value = max(max_value, len(timeline[time]))
-    return max_value
-
-
 EMERGENCY = -1
 T_EMPTY_TO_BF = 0
 AT_BF = 1
@@ -81,6 +71,38 @@ def create_schedule_timeline(instance: Instance, schedule: Schedule):
     return timeline
 
 
+def get_schedule_intervals(instance: Instance, schedule: Schedule):
+    '''Returns the (state, start, end) intervals of a single schedule.'''
+    durations = [
+        instance.tt_empty_buffer_to_bf,
+        instance.dur_bf,
+        instance.tt_bf_to_full_buffer,
+        schedule.buffer_duration,
+        instance.tt_full_buffer_to_desulf,
+        schedule.desulf_duration,
+        instance.tt_desulf_to_converter,
+        schedule.converter_early_arrival + instance.dur_converter
+        + schedule.converter_depart_delay,
+        instance.tt_converter_to_empty_buffer
+    ]
+    intervals = []
+    time = schedule.start_time
+    for state, duration in enumerate(durations):
+        if duration > 0:
+            intervals.append((state, time, time + duration))
+            time += duration
+    return intervals
+
+
+def get_emergency_intervals(instance: Instance, bf_id):
+    '''Returns the (state, start, end) intervals of an emergency run.'''
+    start, end, start_bf, end_bf = instance.get_emergency_interval(bf_id)
+    intervals = [(T_EMPTY_TO_BF, start, start_bf),
+                 (AT_BF, start_bf, end_bf),
+                 (EMERGENCY, end_bf, end)]
+    return [interval for interval in intervals if interval[1] < interval[2]]
+
+
 def get_state_constraints(instance: Instance):
     '''Returns the maximum number of each state for a time slot.'''
     max_states = [
@@ -97,58 +119,6 @@ def get_state_constraints(instance: Instance):
     return max_states
 
 
-def calculate_conflict_count(instance: Instance, timeline, start=0, end=-1):
-    '''Calculate total conflict count for a solution timeline.'''
-    max_states = get_state_constraints(instance)
-    conflicts = []
-    conflict_count = 0
-    max_conflicts = 0
-    max_torpedoes = 0
-    conflict_map = [0 for t in range(STATE_COUNT)]
-    if end < 0:
-        end = len(timeline)
-    for slot in range(start, end):
-        time = timeline[slot]
-        max_torpedoes = max(max_torpedoes, len(time))
-        time_conflict_count = 0
-        state_counts = [0 for t in range(STATE_COUNT)]
-        for _, state in time:
-            if state != EMERGENCY:
-                state_counts[state] += 1
-        for i, state_count in enumerate(state_counts):
-            if state_count > max_states[i]:
-                time_conflict_count += 1
-                conflict_map[i] += 1
-        if time_conflict_count > 0:
-            max_conflicts = max(max_conflicts, time_conflict_count)
-            conflict_count += time_conflict_count
-            conflicts.append((slot, time))
-    return conflicts, conflict_count, max_conflicts, conflict_map, max_torpedoes
-
-
-def create_solution_timeline(instance: Instance, solution, matrix):
-    '''Create a timeline for each time slot of the
-    instance populated with schedules from the solution.
-    '''
-    timeline = instance.create_timeline()
-    for bf_id, converter_id in enumerate(solution):
-        if converter_id == -1:
-            start_time, schedule_timeline = create_emergency_timeline(
-                instance, bf_id)
-            i = start_time
-            for state in schedule_timeline:
-                timeline[i].append((bf_id, state))
-                i += 1
-        else:
-            schedule = matrix[converter_id].sparse_list[bf_id]
-            schedule_timeline = create_schedule_timeline(instance, schedule)
-            i = schedule.start_time
-            for state in schedule_timeline:
-                timeline[i].append((bf_id, state))
-                i += 1
-    return timeline
-
-
 class _TorpedoRun:
 
     @staticmethod
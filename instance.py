@@ -1,5 +1,7 @@
 '''Provides utilities for parsing and modeling problem instances.'''
+import gc
 import re
+import heapq
 
 PROBLEM_PROPERTIES = [
     'durBF',
@@ -16,6 +18,14 @@ PROBLEM_PROPERTIES = [
     'ttBFEmergencyPitEmptyBuffer'
 ]
 
+# Properties that neither get_distance nor the converter schedules use.
+CAPACITY_PROPERTIES = [
+    'nbSlotsFullBuffer',
+    'nbSlotsDesulf',
+    'nbSlotsConverter',
+    'ttBFEmergencyPitEmptyBuffer'
+]
+
 BF_SCHEDULES = 'bfSchedules'
 CONVERTER_SCHEDULES = 'converterSchedules'
 
@@ -68,19 +78,91 @@ def _sort_value(schedule: Schedule):
     return schedule.duration * _SORT_BIAS[schedule.desulf_efficiency + 4]
 
 
+def _merge_value(schedule: Schedule):
+    # Ties keep BF order, as in a stable sort of the sparse list.
+    return _sort_value(schedule), schedule.bf_id
+
+
+class _SortedDomain:
+    '''Sequence of the feasible schedules of a converter in _sort_value
+    order. Schedules are only ordered and indexed up to the furthest
+    position accessed so far.
+
+    All schedules of a converter end at the same time, and BFs of one
+    sulfur level have the same desulf efficiency, so within a level the
+    sort value grows as the BF time falls. The domain is a lazy merge of
+    the BF ids of every level, latest first, as given by bf_orders.
+    '''
+
+    def __init__(self, sparse_list, bf_orders=None):
+        self.items = []
+        self.size = len(sparse_list) - sparse_list.count(None)
+        if bf_orders is None or min(_SORT_BIAS) <= 0:
+            groups = [sorted((schedule for schedule in sparse_list
+                              if schedule is not None), key=_merge_value)]
+        else:
+            groups = [filter(None, map(sparse_list.__getitem__, bf_ids))
+                      for bf_ids in bf_orders]
+        self.source = heapq.merge(*groups, key=_merge_value)
+
+    def _materialize(self, end):
+        items = self.items
+        source = self.source
+        while len(items) < end:
+            schedule = next(source)
+            schedule.index = len(items)
+            items.append(schedule)
+
+    def __getstate__(self):
+        # The lazy merge cannot be pickled, so copies are fully sorted.
+        self._materialize(self.size)
+        return self.items, self.size
+
+    def __setstate__(self, state):
+        self.items, self.size = state
+        self.source = iter(())
+        # Schedules may have been pickled before they were indexed.
+        for index, schedule in enumerate(self.items):
+            schedule.index = index
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            start, stop, step = key.indices(self.size)
+            self._materialize(start + 1 if step < 0 else stop)
+            return self.items[key]
+        if key < 0:
+            key += self.size
+        if not 0 <= key < self.size:
+            raise IndexError('domain index out of range')
+        if key >= len(self.items):
+            self._materialize(key + 1)
+        return self.items[key]
+
+    def __iter__(self):
+        for index in range(self.size):
+            yield self[index]
+
+    def index_of(self, schedule: Schedule):
+        '''Returns the position of a schedule of this domain.'''
+        while schedule.index == -1:
+            if len(self.items) == self.size:
+                raise ValueError('Schedule is not in the domain')
+            self._materialize(len(self.items) + 1)
+        return schedule.index
+
+
 class ScheduleMap:
     '''Caches all feasible paths for a converter schedule.'''
 
-    def __init__(self, converter_id, sparse_list):
+    def __init__(self, converter_id, sparse_list, bf_orders=None):
         self.sparse_list = sparse_list
-        self.sorted_list = sorted(
-            [schedule for schedule in sparse_list if schedule is not None],
-            key=_sort_value)
+        self.sorted_list = _SortedDomain(sparse_list, bf_orders)
         self.domain_size = len(self.sorted_list)
         self.converter_id = converter_id
         self.current_index = -1
-        for index, schedule in enumerate(self.sorted_list):
-            schedule.index = index
 
     def constrain_domain(self, bf_id):
         '''Indicate that bf_id is used somewhere else and narrow the domain.'''
@@ -100,6 +182,10 @@ class ScheduleMap:
             return None
         return self.sorted_list[self.current_index]
 
+    def set_current_schedule(self, schedule: Schedule):
+        '''Make a schedule of this map the current one.'''
+        self.current_index = self.sorted_list.index_of(schedule)
+
 
 class _BFSchedule:
     '''Represents a blast furnace schedule.'''
@@ -194,6 +280,12 @@ class Instance:
         self.dur_emergency = self.tt_empty_buffer_to_bf + \
             self.dur_bf + self.tt_bf_emergency_pit_empty_buffer
 
+        # BF ids per sulfur level, latest first, shared by all schedule maps.
+        levels = dict()
+        for bf in sorted(self.bf_schedules, key=lambda bf: (-bf.time, bf.bf_id)):
+            levels.setdefault(bf.sulf_level, []).append(bf.bf_id)
+        self._bf_orders = list(levels.values())
+
     def _calculate_converter_schedules(self, schedules):
         converter_schedules = [None for s in schedules]
         previous_t_empty = 0
@@ -229,6 +321,19 @@ class Instance:
         '''Returns the raw properties dictionary.'''
         return self._properties
 
+    def override_properties(self, properties):
+        '''Overrides problem properties in place. Schedules created
+        before are not updated, so an instance that is in use should
+        only get new values for CAPACITY_PROPERTIES.
+        '''
+        for prop, value in properties.items():
+            if prop not in PROBLEM_PROPERTIES:
+                raise Exception('Unknown property %s' % prop)
+            setattr(self, _camel_to_snake(prop), value)
+            self._properties[prop] = value
+        self.dur_emergency = self.tt_empty_buffer_to_bf + \
+            self.dur_bf + self.tt_bf_emergency_pit_empty_buffer
+
     def get_distance(self, bf_id, converter_id):
         '''Returns a schedule for a BF-Converter pair.
         Returns None if the schedule is infeasible.
@@ -265,10 +370,6 @@ class Instance:
                         desulf_efficiency, buffer_duration,
                         c.depart_delay, early_arrival, is_pullable)
 
-    def create_timeline(self):
-        '''Create an empty timeline for every time slot in the problem.'''
-        return [[] for t in range(self.get_latest_time() + 1)]
-
     def get_emergency_interval(self, bf_id):
         '''Gets the timeline of an emergency
         run for the specified BF schedule.
@@ -283,26 +384,38 @@ class Instance:
         converter_count = len(self.converter_schedules)
         bf_count = len(self.bf_schedules)
         matrix = [None for row in range(converter_count)]
-        for converter_id in range(converter_count):
-            sparse_list = [None for bf in range(bf_count)]
-            for bf_id in range(bf_count):
-                sparse_list[bf_id] = self.get_distance(bf_id, converter_id)
-            matrix[converter_id] = ScheduleMap(converter_id, sparse_list)
+        # Schedules form no reference cycles, so collecting
+        # while allocating millions of them only costs time.
+        gc_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            for converter_id in range(converter_count):
+                sparse_list = [None for bf in range(bf_count)]
+                for bf_id in range(bf_count):
+                    sparse_list[bf_id] = self.get_distance(bf_id, converter_id)
+                matrix[converter_id] = ScheduleMap(
+                    converter_id, sparse_list, self._bf_orders)
+        finally:
+            if gc_enabled:
+                gc.enable()
         return matrix
 
     def create_schedule_map(self, converter_id):
+        '''Recreate the schedule map of a converter,
+        reusing the BF order of the instance.
+        '''
         bf_count = len(self.bf_schedules)
         sparse_list = [None for bf in range(bf_count)]
         for bf_id in range(bf_count):
             sparse_list[bf_id] = self.get_distance(bf_id, converter_id)
-        return ScheduleMap(converter_id, sparse_list)
+        return ScheduleMap(converter_id, sparse_list, self._bf_orders)
 
     def get_latest_time(self):
         '''Returns the latest timeslot for this instance.'''
-        max_converter = self.converter_schedules[-1].time \
-            + self.dur_converter + self.tt_converter_to_empty_buffer
-        max_emergency = self.bf_schedules[-1].time + \
-            self.tt_bf_emergency_pit_empty_buffer
+        last_converter = self.converter_schedules[-1]
+        max_converter = last_converter.time + self.dur_converter \
+            + last_converter.depart_delay + self.tt_converter_to_empty_buffer
+        max_emergency = self.get_emergency_interval(len(self.bf_schedules) - 1)[1]
         return max(max_converter, max_emergency) + 1
 
     def __repr__(self):
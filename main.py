@@ -1,17 +1,31 @@
 '''Program entry'''
 import sys
+import time
 import json
 import os.path
 import evaluator
+import verifier
+import daemon
+import analysis
+import sweep
 from instance import Instance
-from solution import find_initial_solution, hill_climb, ConflictTimeline, resolve_conflicts
+from solution import find_initial_solution, hill_climb, reduce_peak, \
+    compound_climb, optimize, ConflictTimeline, resolve_conflicts
+from parallel import parallel_hill_climb
+from telemetry import Telemetry
+from profiler import Profiler
 
 
-def _print_solution(instance, solution, matrix, timeline, conflicts, torpedo_count):
+def _print_solution(instance, solution, matrix, timeline, conflicts, torpedo_count,
+                    telemetry=None):
     desulf_time = evaluator.calculate_desulf_time(solution, matrix)
     total_time = evaluator.calculate_total_time(instance, solution, matrix)
     cost = evaluator.evaluate_solution(instance, torpedo_count, desulf_time)
     gain = evaluator.evaluate_gain(instance, cost)
+    if telemetry is not None:
+        telemetry.emit('done', torpedo_count=torpedo_count,
+                       desulf_time=desulf_time, total_time=total_time,
+                       conflicts=conflicts, cost=cost)
     print('Torpedo count: {}'.format(torpedo_count))
     print('Desulf time: {}'.format(desulf_time))
     print('Total time: {}'.format(total_time))
@@ -20,9 +34,79 @@ def _print_solution(instance, solution, matrix, timeline, conflicts, torpedo_cou
     print('Gain evaluation: {}'.format(gain))
 
 
+def _print_compound(evaluated, elapsed):
+    print('Evaluated {} compound moves in {:.2f}s ({:.0f} moves/s)'.format(
+        evaluated, elapsed, evaluated / elapsed if elapsed > 0 else 0))
+
+
+def _print_sweep(grid, results):
+    columns = [prop for prop, _ in grid] + ['torpedoCount', 'desulfTime',
+                                            'conflicts', 'cost']
+    widths = [max(12, len(column)) for column in columns]
+    print('  '.join(column.rjust(width) for column, width in zip(columns, widths)))
+    for overrides, result in results:
+        values = [str(overrides[prop]) for prop, _ in grid]
+        if 'error' in result:
+            values.append(result['error'])
+        else:
+            values.extend([str(result['torpedo_count']), str(result['desulf_time']),
+                           str(sum(result['conflicts'])),
+                           '{:.4f}'.format(result['cost'])])
+        print('  '.join(value.rjust(width) for value, width in zip(values, widths)))
+
+
+def _pop_option(argv, name):
+    '''Remove an option given as "name value" or "name=value"
+    from argv and return its value, or None if it is missing.
+    '''
+    for i, arg in enumerate(argv):
+        if arg == name and i + 1 < len(argv):
+            value = argv[i + 1]
+            del argv[i:i + 2]
+            return value
+        elif arg.startswith(name + '='):
+            del argv[i]
+            return arg[len(name) + 1:]
+    return None
+
+
 def main(argv):
-    '''Main entry, argv = [command, problem instance]'''
+    '''Main entry, argv = [command, problem instance, options...]
+    Options:
+        --telemetry PATH|FD         Stream solve progress as JSON Lines.
+        --profile PATH              Write collapsed profiler stacks to PATH
+                                    and a table of the top functions to stderr.
+        --profile-phase PHASE       Only profile one phase, e.g. optimize
+                                    for hill_climb.
+        --profile-mode trace|sample Deterministic or sampling profiler.
+        --profile-top N             Number of functions in the table.
+    '''
+    argv = list(argv)
+    target = _pop_option(argv, '--telemetry')
+    profile_path = _pop_option(argv, '--profile')
+    profile_phase = _pop_option(argv, '--profile-phase')
+    profile_mode = _pop_option(argv, '--profile-mode') or 'trace'
+    profile_top = int(_pop_option(argv, '--profile-top') or 30)
+    if profile_phase is not None and profile_path is None:
+        print('Usage: --profile-phase requires --profile PATH')
+        return 1
+    telemetry = None if target is None else Telemetry.open(target)
+    profiler = None if profile_path is None else Profiler(profile_mode)
+    if profiler is not None and profile_phase is None:
+        profiler.start()
+    try:
+        return _run(argv, telemetry, profiler, profile_phase)
+    finally:
+        if telemetry is not None:
+            telemetry.close()
+        if profiler is not None:
+            profiler.stop()
+            profiler.write_table(sys.stderr, profile_top)
+            with open(profile_path, 'w') as file:
+                profiler.write_collapsed(file)
 
+
+def _run(argv, telemetry, profiler=None, profile_phase=None):
     if len(argv) < 2:
         print('Usage: arg1=command arg2=problem instance)')
         return
@@ -31,6 +115,25 @@ def main(argv):
         with open(argv[1]) as file:
             return Instance.parse(file.readlines())
 
+    phase_times = dict()
+
+    def _phase(message, phase):
+        phase_times[phase] = time.time()
+        if profile_phase is not None and phase != profile_phase:
+            profiler.stop()
+        print(message)
+        if telemetry is not None:
+            telemetry.emit('phase', phase=phase)
+        if profile_phase is not None and phase == profile_phase:
+            profiler.start()
+
+    def _optimize(instance, solution, matrix, timeline):
+        timeline, evaluated = optimize(instance, solution, matrix, timeline,
+                                       telemetry, _phase)
+        end_time = phase_times.get('resolve_conflicts', time.time())
+        _print_compound(evaluated, end_time - phase_times['compound'])
+        return timeline
+
     command = argv[0]
     if command == 'echo_ins':   # Parse and echo same instance for tesing.
         print(repr(_get_instance()))
@@ -38,27 +141,58 @@ def main(argv):
         print(json.dumps(_get_instance().get_properties(),
                          indent=4, separators=(',', ': ')))
     elif command == 'solve':
-        print('Parsing instance...')
+        _phase('Parsing instance...', 'parse')
         instance = _get_instance()
-        print('Finding initial solution...')
+        _phase('Finding initial solution...', 'initial_solution')
         solution, matrix = find_initial_solution(instance)
-        print('Optimizing solution...')
-        timeline = hill_climb(instance, solution, matrix)
+        _phase('Optimizing solution...', 'optimize')
+        timeline = hill_climb(instance, solution, matrix,
+                              telemetry=telemetry)
+        timeline = _optimize(instance, solution, matrix, timeline)
+        conflicts, torpedo_count = timeline.count_conflicts()
+        _phase('Evaluating solution...', 'evaluate')
+        _print_solution(instance, solution, matrix,
+                        timeline, conflicts, torpedo_count, telemetry)
+    elif command == 'parallel_solve':   # Optional arg3=worker count
+        workers = int(argv[2]) if len(argv) > 2 else None
+        _phase('Parsing instance...', 'parse')
+        instance = _get_instance()
+        _phase('Finding initial solution...', 'initial_solution')
+        solution, matrix = find_initial_solution(instance)
+        _phase('Optimizing solution in parallel...', 'optimize')
+        timeline = parallel_hill_climb(
+            instance, solution, matrix, workers=workers, telemetry=telemetry)
+        timeline = _optimize(instance, solution, matrix, timeline)
+        conflicts, torpedo_count = timeline.count_conflicts()
+        _phase('Evaluating solution...', 'evaluate')
+        _print_solution(instance, solution, matrix,
+                        timeline, conflicts, torpedo_count, telemetry)
+    elif command == 'memetic_solve':    # Requires NumPy
+        from population import memetic_solve
+        _phase('Parsing instance...', 'parse')
+        instance = _get_instance()
+        _phase('Evolving solution...', 'evolve')
+        start_time = time.time()
+        solution, matrix, population_evaluator = memetic_solve(instance)
+        elapsed = time.time() - start_time
+        print('Evaluated {} candidates in {:.2f}s'.format(
+            population_evaluator.evaluated, elapsed))
+        timeline = ConflictTimeline.create(instance, solution, matrix)
         conflicts, torpedo_count = timeline.count_conflicts()
         if sum(conflicts) > 0:
-            print('Resolving conflicts...')
+            _phase('Resolving conflicts...', 'resolve_conflicts')
             resolve_conflicts(instance, solution, matrix)
             timeline = ConflictTimeline.create(instance, solution, matrix)
             conflicts, torpedo_count = timeline.count_conflicts()
-        print('Evaluating solution...')
+        _phase('Evaluating solution...', 'evaluate')
         _print_solution(instance, solution, matrix,
                         timeline, conflicts, torpedo_count)
     elif command == 'initial_solution':
-        print('Parsing instance...')
+        _phase('Parsing instance...', 'parse')
         instance = _get_instance()
-        print('Finding initial solution...')
+        _phase('Finding initial solution...', 'initial_solution')
         solution, matrix = find_initial_solution(instance)
-        print('Evaluating initial solution...')
+        _phase('Evaluating initial solution...', 'evaluate')
         timeline = ConflictTimeline.create(instance, solution, matrix)
         conflicts, torpedo_count = timeline.count_conflicts()
         _print_solution(instance, solution, matrix,
@@ -66,8 +200,8 @@ def main(argv):
     elif command == 'print_solution':
         instance = _get_instance()
         solution, matrix = find_initial_solution(instance)
-        hill_climb(instance, solution, matrix)
-        resolve_conflicts(instance, solution, matrix)
+        timeline = hill_climb(instance, solution, matrix)
+        optimize(instance, solution, matrix, timeline)
         runs, torpedoes = evaluator.calculate_solution_runs(
             instance, solution, matrix)
         print(os.path.basename(argv[1]))
@@ -76,6 +210,71 @@ def main(argv):
         print()
         for run in runs:
             print(run)
+    elif command == 'verify':   # arg3=solution file
+        if len(argv) < 3:
+            print('Usage: verify <problem instance> <solution file>')
+            return 1
+        instance = _get_instance()
+        with open(argv[2]) as file:
+            torpedo_count, runs, errors = verifier.parse_solution(
+                file.readlines())
+        if len(errors) > 0:
+            for error in errors:
+                print(error)
+            print('Violations: {}'.format(len(errors)))
+            return 1
+        errors, peak_torpedoes, desulf_time, cost = verifier.verify_solution(
+            instance, torpedo_count, runs)
+        for error in errors:
+            print(error)
+        print('Violations: {}'.format(len(errors)))
+        print('Torpedo count: {}'.format(torpedo_count))
+        print('Peak torpedoes: {}'.format(peak_torpedoes))
+        print('Desulf time: {}'.format(desulf_time))
+        print('Cost evaluation: {}'.format(cost))
+        return 1 if len(errors) > 0 else 0
+    elif command == 'serve':    # arg2=socket path or port, optional arg3=worker count
+        workers = int(argv[2]) if len(argv) > 2 else None
+        daemon.serve(argv[1], workers)
+    elif command == 'request':  # arg2=socket path or port, arg3=command, arg4=instance, optional arg5=solution file
+        if len(argv) < 4:
+            print('Usage: request <socket path or port> <command> <problem instance> [solution file]')
+            return 1
+        request = {'id': 1, 'command': argv[2], 'instance': os.path.abspath(argv[3])}
+        if len(argv) > 4:
+            request['solution'] = os.path.abspath(argv[4])
+        response = daemon.send_request(argv[1], request)
+        result = response.get('result', dict())
+        if 'text' in result:
+            print(result['text'], end='')
+        else:
+            print(json.dumps(response, indent=4, separators=(',', ': ')))
+        return 1 if 'error' in response else 0
+    elif command == 'sweep':    # arg3...=property=value,value,... optional last arg=worker count
+        args = argv[2:]
+        workers = int(args.pop()) if len(args) > 0 and args[-1].isdigit() else None
+        if len(args) == 0:
+            print('Usage: sweep <problem instance> <property=value,...>... [workers]')
+            return 1
+        try:
+            grid = sweep.parse_grid(args)
+        except ValueError as error:
+            print(error)
+            print('Usage: sweep <problem instance> <property=value,...>... [workers]')
+            return 1
+        _print_sweep(grid, sweep.sweep(_get_instance(), grid, workers))
+    elif command == 'analyze':  # Optional arg3=histogram bin count
+        bins = int(argv[2]) if len(argv) > 2 else 50
+        report = analysis.analyze_instance(_get_instance(), bins)
+        print(json.dumps(report, indent=4, separators=(',', ': ')))
+    elif command == 'check_moves':  # Check compound move shortcuts against full evaluation
+        instance = _get_instance()
+        solution, matrix = find_initial_solution(instance)
+        timeline = hill_climb(instance, solution, matrix)
+        timeline = reduce_peak(instance, solution, matrix, timeline)
+        _, evaluated = compound_climb(instance, solution, matrix,
+                                      timeline=timeline, verify=True)
+        print('Checked {} compound moves against full evaluation'.format(evaluated))
     elif command == 'echo_converters':
         instance = _get_instance()
         for converter in instance.converter_schedules:
@@ -91,4 +290,4 @@ def main(argv):
         return
 
 if __name__ == '__main__':
-    main(sys.argv[1:])
+    sys.exit(main(sys.argv[1:]))
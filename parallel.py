@@ -0,0 +1,143 @@
+'''Time-decomposed parallel optimization.'''
+import os
+import multiprocessing
+from array import array
+from bisect import bisect_left, bisect_right
+from concurrent.futures import ProcessPoolExecutor
+from instance import Instance
+from solution import hill_climb, ConflictTimeline
+from shared import SharedInstance
+
+_worker_state = None
+
+
+def get_trip_spans(instance: Instance, solution, matrix):
+    '''Returns the (start, end) span of every trip in the solution.'''
+    spans = []
+    for bf_id, converter_id in enumerate(solution):
+        if converter_id == -1:
+            spans.append(instance.get_emergency_interval(bf_id)[:2])
+        else:
+            schedule = matrix[converter_id].sparse_list[bf_id]
+            spans.append((schedule.start_time, schedule.end_time))
+    return spans
+
+
+def split_horizon(instance: Instance, solution, matrix, count):
+    '''Splits the horizon into at most count disjoint (start, end) windows.
+    Each cut is placed near an equal share of trips, at the time crossed
+    by the fewest trips of the current solution.
+    '''
+    spans = get_trip_spans(instance, solution, matrix)
+    starts = sorted(span[0] for span in spans)
+    ends = sorted(span[1] for span in spans)
+    trip_count = len(ends)
+    latest_time = instance.get_latest_time() + 1
+
+    def _crossing(time):
+        return bisect_left(starts, time) - bisect_right(ends, time)
+
+    cuts = [0]
+    for part in range(1, count):
+        low = trip_count * (4 * part - 1) // (4 * count)
+        high = trip_count * (4 * part + 1) // (4 * count)
+        candidates = [time for time in ends[low:high + 1] if time > cuts[-1]]
+        if len(candidates) > 0:
+            cuts.append(min(candidates, key=_crossing))
+    cuts.append(latest_time)
+    return [(cuts[i], cuts[i + 1]) for i in range(len(cuts) - 1)]
+
+
+def _crosses(schedule, borders):
+    '''Check whether a trip spans one of the sorted border times.'''
+    position = bisect_right(borders, schedule.start_time)
+    return position < len(borders) and borders[position] < schedule.end_time
+
+
+def _init_worker(name, solution, max_lookahead):
+    '''Attaches to the shared instance data. Only the solution and the
+    schedules a worker touches are copied into the worker.
+    '''
+    global _worker_state
+    shared = SharedInstance.attach(name)
+    _worker_state = shared.get_instance(), solution, shared.get_matrix(), \
+        max_lookahead, shared
+
+
+def _init_forked_worker(instance, solution, matrix, max_lookahead):
+    '''Keeps the objects a forked worker inherited from the parent.'''
+    global _worker_state
+    _worker_state = instance, solution, matrix, max_lookahead, None
+
+
+def _optimize_window(window):
+    '''Optimizes one window on a timeline of its own slots and
+    returns the changes it made.
+    '''
+    instance, solution, matrix, max_lookahead, _ = _worker_state
+    original_solution = list(solution)
+    original_indices = [schedule_map.current_index for schedule_map in matrix]
+    timeline = hill_climb(instance, solution, matrix, max_lookahead,
+                          window=window, timeline=ConflictTimeline.create(
+                              instance, solution, matrix, window))
+    solution_changes = [(bf_id, converter_id)
+                        for bf_id, converter_id in enumerate(solution)
+                        if converter_id != original_solution[bf_id]]
+    index_changes = [(converter_id, schedule_map.current_index)
+                     for converter_id, schedule_map in enumerate(matrix)
+                     if schedule_map.current_index != original_indices[converter_id]]
+    start, end = window
+    return solution_changes, index_changes, timeline.get_segment(start, end)
+
+
+def parallel_hill_climb(instance: Instance, solution, matrix,
+                        max_lookahead=32, workers=None, telemetry=None):
+    '''Runs hill climbing on independent time windows in a process pool,
+    merges the results and reconciles trips crossing window borders with
+    a final sequential pass over their converters.
+    '''
+    if workers is None:
+        workers = os.cpu_count() or 1
+    windows = split_horizon(instance, solution, matrix, workers)
+    if len(windows) < 2:
+        return hill_climb(instance, solution, matrix, max_lookahead,
+                          telemetry=telemetry)
+
+    # Forked workers inherit the instance and matrix without copying or
+    # pickling, so they are only packed into shared memory for workers
+    # started with spawn or forkserver.
+    shared = None
+    if multiprocessing.get_start_method() == 'fork':
+        initializer = _init_forked_worker
+        initargs = instance, solution, matrix, max_lookahead
+    else:
+        shared = SharedInstance.create(instance, matrix)
+        initializer = _init_worker
+        initargs = shared.name, solution, max_lookahead
+    try:
+        with ProcessPoolExecutor(len(windows), initializer=initializer,
+                                 initargs=initargs) as executor:
+            results = list(executor.map(_optimize_window, windows))
+    finally:
+        if shared is not None:
+            shared.close()
+            shared.unlink()
+
+    # Windows are disjoint in time and cover the horizon, so every
+    # trip and time slot was changed by at most one worker, and the
+    # window segments make up the whole timeline.
+    timeline = array('h')
+    for solution_changes, index_changes, segment in results:
+        for bf_id, converter_id in solution_changes:
+            solution[bf_id] = converter_id
+        for converter_id, current_index in index_changes:
+            matrix[converter_id].current_index = current_index
+        timeline.extend(segment)
+
+    # Border trips were frozen in the workers.
+    borders = [window[1] for window in windows[:-1]]
+    converters = [converter_id for converter_id, schedule_map in enumerate(matrix)
+                  if _crosses(schedule_map.get_current_schedule(), borders)]
+    return hill_climb(instance, solution, matrix, max_lookahead,
+                      timeline=ConflictTimeline(instance, timeline),
+                      telemetry=telemetry, converters=converters)
@@ -0,0 +1,252 @@
+'''Batch evaluation of solution populations and a memetic solver.
+Requires NumPy.
+'''
+import random
+import numpy as np
+import evaluator
+from instance import Instance
+from evaluator import STATE_COUNT, EMERGENCY, T_FULL_TO_DESULF
+from solution import find_initial_solution, hill_climb
+
+# Added to the cost for every conflicting slot of a candidate.
+_CONFLICT_PENALTY = 10
+
+
+def _sweep(starts, ends):
+    '''Sorts the interval events of every solution in a population.
+    Returns the owner, time and running count after each event.
+    Departures are sorted before arrivals at the same time, so the
+    running count never overshoots within a time slot.
+    '''
+    mask = ends > starts
+    owners = np.broadcast_to(
+        np.arange(starts.shape[0])[:, None], starts.shape)[mask]
+    times = np.concatenate([starts[mask], ends[mask]])
+    owners = np.concatenate([owners, owners])
+    deltas = np.concatenate([np.ones(len(times) // 2, np.int64),
+                             -np.ones(len(times) // 2, np.int64)])
+    if len(times) == 0:
+        return owners, times, deltas
+    # One packed key sorts much faster than a lexsort over three keys.
+    low = times.min()
+    span = 2 * (times.max() - low + 1)
+    keys = owners * span + 2 * (times - low) + (deltas > 0)
+    order = np.argsort(keys, kind='stable')
+    return owners[order], times[order], np.cumsum(deltas[order])
+
+
+def _get_bounds(start, intervals):
+    '''Returns the start of every state and the end of the last one
+    from the (state, start, end) intervals of a trip starting at start.
+    Missing states start and end where the next state starts, and the
+    emergency pit interval is left out.
+    '''
+    bounds = [start for state in range(STATE_COUNT + 1)]
+    for state, _, end in intervals:
+        if state != EMERGENCY:
+            bounds[state + 1:] = [end] * (STATE_COUNT - state)
+    return bounds
+
+
+class PopulationEvaluator:
+    '''Scores populations of BF to converter assignment vectors at once.
+    Attributes of the feasible pairs in use are fetched from the matrix
+    on first use and cached in flat arrays.
+    '''
+
+    def __init__(self, instance: Instance, matrix):
+        self.instance = instance
+        self.matrix = matrix
+        self.max_states = np.array(evaluator.get_state_constraints(instance))
+        self.converter_count = len(instance.converter_schedules)
+        self.evaluated = 0
+        self._keys = np.empty(0, np.int64)
+        self._bounds = np.empty((0, STATE_COUNT + 1), np.int64)
+        self._desulf = np.empty(0, np.int64)
+
+        emergency = [instance.get_emergency_interval(bf_id)
+                     for bf_id in range(len(instance.bf_schedules))]
+        self._emergency_bounds = np.array(
+            [_get_bounds(interval[0], evaluator.get_emergency_intervals(
+                instance, bf_id)) for bf_id, interval in enumerate(emergency)],
+            np.int64)
+        self._emergency_ends = np.array(
+            [interval[1] for interval in emergency], np.int64)
+
+    def _lookup(self, keys):
+        '''Returns cache rows for bf_id * converter_count + converter_id keys.'''
+        new_keys = np.setdiff1d(keys, self._keys)
+        if len(new_keys) > 0:
+            bounds = []
+            desulf = []
+            for key in new_keys.tolist():
+                bf_id, converter_id = divmod(key, self.converter_count)
+                schedule = self.matrix[converter_id].sparse_list[bf_id]
+                if schedule is None or not schedule.is_pullable:
+                    raise ValueError('BF {} cannot be assigned to converter {}'
+                                     .format(bf_id, converter_id))
+                bounds.append(_get_bounds(schedule.start_time,
+                                          evaluator.get_schedule_intervals(
+                                              self.instance, schedule)))
+                desulf.append(schedule.desulf_duration)
+            keys_all = np.concatenate([self._keys, new_keys])
+            order = np.argsort(keys_all, kind='stable')
+            self._keys = keys_all[order]
+            self._bounds = np.concatenate(
+                [self._bounds, np.array(bounds, np.int64)])[order]
+            self._desulf = np.concatenate(
+                [self._desulf, np.array(desulf, np.int64)])[order]
+        return np.searchsorted(self._keys, keys)
+
+    def evaluate(self, population):
+        '''Evaluates a (solutions x BF) array of converter ids, -1 for an
+        emergency run. Returns arrays of desulf time, total time, peak
+        torpedo count, a (solutions x states) conflict map and cost.
+        '''
+        instance = self.instance
+        population = np.asarray(population, np.int64)
+        count, bf_count = population.shape
+        bf_ids = np.broadcast_to(np.arange(bf_count), population.shape)
+        emergency = population < 0
+        assigned = ~emergency
+
+        rows = self._lookup(bf_ids[assigned] * self.converter_count
+                            + population[assigned])
+        bounds = np.empty((count, bf_count, STATE_COUNT + 1), np.int64)
+        bounds[emergency] = self._emergency_bounds[bf_ids[emergency]]
+        bounds[assigned] = self._bounds[rows]
+        ends = bounds[:, :, STATE_COUNT].copy()
+        ends[emergency] = self._emergency_ends[bf_ids[emergency]]
+
+        desulf = np.zeros(population.shape, np.int64)
+        desulf[assigned] = self._desulf[rows]
+        desulf_time = desulf.sum(axis=1)
+        durations = ends - bounds[:, :, 0]
+        durations[emergency] = instance.dur_emergency
+        total_time = durations.sum(axis=1)
+
+        conflict_map = np.zeros((count, STATE_COUNT), np.int64)
+        for state in range(STATE_COUNT):
+            owners, times, counts = _sweep(
+                bounds[:, :, state], bounds[:, :, state + 1])
+            if len(times) < 2:
+                continue
+            lengths = np.where(owners[1:] == owners[:-1],
+                               times[1:] - times[:-1], 0)
+            lengths *= counts[:-1] > self.max_states[state]
+            conflict_map[:, state] = np.bincount(
+                owners[:-1], lengths, minlength=count)
+
+        owners, times, counts = _sweep(bounds[:, :, 0], ends)
+        torpedo_count = np.zeros(count, np.int64)
+        np.maximum.at(torpedo_count, owners, counts)
+
+        cost = evaluator.evaluate_solution(instance, torpedo_count, desulf_time)
+        self.evaluated += count
+        return desulf_time, total_time, torpedo_count, conflict_map, cost
+
+
+def _sync_matrix(solution, matrix):
+    '''Points every schedule map at the schedule chosen by the solution.'''
+    for bf_id, converter_id in enumerate(solution):
+        if converter_id != -1:
+            schedule_map = matrix[converter_id]
+            schedule_map.set_current_schedule(schedule_map.sparse_list[bf_id])
+
+
+def _mutate(solution, matrix, swaps, rng: random.Random, lookahead=8):
+    '''Returns a copy of the solution with random pairwise
+    exchanges between converters, using the hill_climb moves.
+    '''
+    child = list(solution)
+    owners = dict((converter_id, bf_id)
+                  for bf_id, converter_id in enumerate(child)
+                  if converter_id != -1)
+    for i in range(swaps):
+        converter1 = rng.randrange(len(matrix))
+        schedule_map1 = matrix[converter1]
+        bf1 = owners[converter1]
+        domain = schedule_map1.sorted_list
+        limit = min(len(domain),
+                    domain.index_of(schedule_map1.sparse_list[bf1]) + 1 + lookahead)
+        new1 = domain[rng.randrange(limit)]
+        bf2 = new1.bf_id
+        if bf2 == bf1 or not new1.is_pullable:
+            continue
+        converter2 = child[bf2]
+        if converter2 != -1:
+            new2 = matrix[converter2].sparse_list[bf1]
+            if new2 is None or not new2.is_pullable:
+                continue
+            owners[converter2] = bf1
+        child[bf1] = converter2
+        child[bf2] = converter1
+        owners[converter1] = bf2
+    return child
+
+
+def memetic_solve(instance: Instance, population_size=64, generations=10,
+                  elite_count=2, max_lookahead=4, seed=0):
+    '''Evolves a population of solutions seeded from the hill climbing
+    solution, improving the elites of every generation with hill_climb.
+    Returns the solution, matrix and evaluator.
+    '''
+    rng = random.Random(seed)
+    solution, matrix = find_initial_solution(instance)
+    hill_climb(instance, solution, matrix)
+    population_evaluator = PopulationEvaluator(instance, matrix)
+    population = [solution] + [_mutate(solution, matrix, rng.randint(1, 3), rng)
+                               for i in range(population_size - 1)]
+    best = None
+    best_fitness = None
+    # Lowest penalized fitness, used when no candidate is conflict-free.
+    fallback = None
+    fallback_fitness = None
+    refined = set()
+    for generation in range(generations):
+        _, _, _, conflict_map, cost = population_evaluator.evaluate(population)
+        conflicts = conflict_map.sum(axis=1) - conflict_map[:, T_FULL_TO_DESULF]
+        fitness = cost + _CONFLICT_PENALTY * conflicts
+        order = np.argsort(fitness, kind='stable')
+        if conflicts[order[0]] == 0 and (
+                best_fitness is None or fitness[order[0]] < best_fitness):
+            best = list(population[order[0]])
+            best_fitness = fitness[order[0]]
+        if fallback_fitness is None or fitness[order[0]] < fallback_fitness:
+            fallback = list(population[order[0]])
+            fallback_fitness = fitness[order[0]]
+
+        # Elites that survived unchanged were refined already.
+        elites = []
+        for index in order[:elite_count].tolist():
+            elite = list(population[index])
+            if tuple(elite) not in refined:
+                _sync_matrix(elite, matrix)
+                hill_climb(instance, elite, matrix, max_lookahead)
+                refined.add(tuple(elite))
+            elites.append(elite)
+
+        def _select():
+            first, second = rng.randrange(len(population)), \
+                rng.randrange(len(population))
+            return population[first if fitness[first] <= fitness[second] else second]
+
+        population = elites + [_mutate(_select(), matrix, rng.randint(1, 3), rng)
+                               for i in range(population_size - len(elites))]
+
+    # Elites of the last generation have not been scored yet.
+    _, _, _, conflict_map, cost = population_evaluator.evaluate(population)
+    conflicts = conflict_map.sum(axis=1) - conflict_map[:, T_FULL_TO_DESULF]
+    for index in range(len(population)):
+        fitness = cost[index]
+        if conflicts[index] == 0 and (best_fitness is None or fitness < best_fitness):
+            best = list(population[index])
+            best_fitness = fitness
+        fitness += _CONFLICT_PENALTY * conflicts[index]
+        if fitness < fallback_fitness:
+            fallback = list(population[index])
+            fallback_fitness = fitness
+
+    solution[:] = best if best is not None else fallback
+    _sync_matrix(solution, matrix)
+    return solution, matrix, population_evaluator
@@ -0,0 +1,147 @@
+'''Deterministic and sampling profilers with collapsed-stack output.'''
+import os
+import sys
+import threading
+from time import perf_counter
+from collections import defaultdict
+
+MODES = ('trace', 'sample')
+
+
+def _code_label(code):
+    return '{} ({}:{})'.format(getattr(code, 'co_qualname', code.co_name),
+                               os.path.basename(code.co_filename),
+                               code.co_firstlineno)
+
+
+def _builtin_label(function):
+    name = getattr(function, '__qualname__', None) \
+        or getattr(function, '__name__', repr(function))
+    return '{} (built-in)'.format(name)
+
+
+class Profiler:
+    '''Records the time spent in every distinct call stack.
+    In trace mode every call and return is timed through sys.setprofile,
+    which gives exact call counts at a high overhead. In sample mode a
+    background thread records the stack of the profiled thread every
+    interval seconds, which distorts timings much less.
+    Profiling can be started and stopped repeatedly; time accumulates.
+    '''
+
+    def __init__(self, mode='trace', interval=0.005):
+        if mode not in MODES:
+            raise ValueError('Unknown profile mode {}'.format(mode))
+        self.mode = mode
+        self.interval = interval
+        self.stacks = defaultdict(float)
+        self.calls = defaultdict(int)
+        self.elapsed = 0.0
+        self.running = False
+        self._start_time = None
+        self._stack = []
+        self._last = None
+        self._thread_id = None
+        self._sampler = None
+        self._stopping = None
+
+    def start(self):
+        '''Start profiling the calling thread.'''
+        if self.running:
+            return
+        self.running = True
+        self._start_time = perf_counter()
+        if self.mode == 'trace':
+            self._stack = []
+            self._last = perf_counter()
+            sys.setprofile(self._trace)
+        else:
+            self._thread_id = threading.get_ident()
+            self._stopping = threading.Event()
+            self._sampler = threading.Thread(target=self._sample_loop,
+                                             daemon=True)
+            self._sampler.start()
+
+    def stop(self):
+        '''Stop profiling.'''
+        if not self.running:
+            return
+        if self.mode == 'trace':
+            sys.setprofile(None)
+        else:
+            self._stopping.set()
+            self._sampler.join()
+        self.elapsed += perf_counter() - self._start_time
+        self.running = False
+
+    def _trace(self, frame, event, arg):
+        now = perf_counter()
+        stack = self._stack
+        if stack:
+            self.stacks[stack[-1]] += now - self._last
+        if event == 'call' or event == 'c_call':
+            label = _code_label(frame.f_code) if event == 'call' \
+                else _builtin_label(arg)
+            stack.append(stack[-1] + (label,) if stack else (label,))
+            self.calls[label] += 1
+        elif stack:
+            # Frames entered before start() return to an empty stack.
+            stack.pop()
+        # Exclude the time spent in the tracer itself.
+        self._last = perf_counter()
+
+    def _sample_loop(self):
+        samples = defaultdict(int)
+        start_time = perf_counter()
+        while not self._stopping.wait(self.interval):
+            frame = sys._current_frames().get(self._thread_id)
+            path = []
+            while frame is not None:
+                path.append(_code_label(frame.f_code))
+                frame = frame.f_back
+            if path:
+                path.reverse()
+                samples[tuple(path)] += 1
+        # The sampler only runs when the profiled thread releases the GIL,
+        # so samples get equal weight instead of the time between them.
+        weight = (perf_counter() - start_time) / max(1, sum(samples.values()))
+        for path, count in samples.items():
+            self.stacks[path] += weight * count
+
+    def get_functions(self):
+        '''Returns (label, self time, total time, calls) for every
+        function, sorted by decreasing self time. Calls are None in
+        sample mode. Recursive calls count once towards total time.
+        '''
+        self_times = defaultdict(float)
+        total_times = defaultdict(float)
+        for path, elapsed in self.stacks.items():
+            self_times[path[-1]] += elapsed
+            for label in set(path):
+                total_times[label] += elapsed
+        functions = [(label, self_times[label], total,
+                      self.calls[label] if self.mode == 'trace' else None)
+                     for label, total in total_times.items()]
+        functions.sort(key=lambda function: (-function[1], -function[2]))
+        return functions
+
+    def write_table(self, stream, top=30):
+        '''Write the top functions by self time as a text table.'''
+        recorded = sum(self.stacks.values()) or 1.0
+        stream.write('Profiled {:.3f}s in {} mode\n'.format(self.elapsed, self.mode))
+        stream.write('{:>10} {:>7} {:>10} {:>7} {:>10}  {}\n'.format(
+            'self_s', 'self%', 'total_s', 'total%', 'calls', 'function'))
+        for label, self_time, total_time, calls in self.get_functions()[:top]:
+            stream.write('{:10.4f} {:6.1f}% {:10.4f} {:6.1f}% {:>10}  {}\n'.format(
+                self_time, 100 * self_time / recorded,
+                total_time, 100 * total_time / recorded,
+                '-' if calls is None else calls, label))
+
+    def write_collapsed(self, stream):
+        '''Write stacks in the collapsed format read by flame graph tools,
+        one "frame;frame;frame value" line per stack, in microseconds.
+        '''
+        for path, elapsed in sorted(self.stacks.items()):
+            microseconds = int(round(elapsed * 1e6))
+            if microseconds > 0:
+                stream.write('{} {}\n'.format(';'.join(path), microseconds))
@@ -0,0 +1,265 @@
+'''Instance data in shared memory for worker processes.
+
+The instance, its converter schedules and the feasible schedules of
+every converter are packed into flat int32 tables in one shared memory
+block. Workers attach to the block by name and read the tables through
+memoryviews, so nothing is copied and attaching takes constant time.
+Objects are only built for the rows a worker touches, and solutions,
+current indices and timelines stay private to each worker.
+'''
+from array import array
+from itertools import chain
+from operator import attrgetter
+from multiprocessing import shared_memory
+from instance import Instance, ScheduleMap, Schedule, PROBLEM_PROPERTIES, \
+    _BFSchedule, _ConverterSchedule, _camel_to_snake
+
+_BF_FIELDS = 3
+_CONVERTER_FIELDS = 5
+_SCHEDULE_FIELDS = 10
+_HEADER = 3 + len(PROBLEM_PROPERTIES)
+_schedule_fields = attrgetter(
+    'bf_id', 'converter_id', 'start_time', 'end_time', 'desulf_duration',
+    'desulf_efficiency', 'buffer_duration', 'converter_depart_delay',
+    'converter_early_arrival', 'is_pullable')
+
+
+class _LazySequence:
+    '''Read-only sequence that builds each item on first access.'''
+
+    def __init__(self, size, factory):
+        self.size = size
+        self.factory = factory
+        self.items = dict()
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(self.size))]
+        if index < 0:
+            index += self.size
+        if not 0 <= index < self.size:
+            raise IndexError('index out of range')
+        item = self.items.get(index)
+        if item is None:
+            item = self.factory(index)
+            self.items[index] = item
+        return item
+
+    def __iter__(self):
+        for index in range(self.size):
+            yield self[index]
+
+
+class _SortedRows(_LazySequence):
+    '''Sorted domain of a converter, read from its schedule rows.'''
+
+    def __init__(self, rows):
+        super().__init__(len(rows) // _SCHEDULE_FIELDS, self._create)
+        self.rows = rows
+
+    def _create(self, index):
+        offset = index * _SCHEDULE_FIELDS
+        row = self.rows[offset:offset + _SCHEDULE_FIELDS]
+        schedule = Schedule(*row[:-1], bool(row[-1]))
+        schedule.index = index
+        return schedule
+
+    def index_of(self, schedule: Schedule):
+        '''Returns the position of a schedule of this domain.'''
+        return schedule.index
+
+
+class _SparseRows:
+    '''Sparse list of a converter, mapping BF ids to sorted positions.'''
+
+    def __init__(self, positions, sorted_list):
+        self.positions = positions
+        self.sorted_list = sorted_list
+
+    def __len__(self):
+        return len(self.positions)
+
+    def __getitem__(self, bf_id):
+        position = self.positions[bf_id]
+        return None if position == -1 else self.sorted_list[position]
+
+    def __iter__(self):
+        for bf_id in range(len(self.positions)):
+            yield self[bf_id]
+
+
+class _SharedScheduleMap(ScheduleMap):
+    '''Schedule map whose schedules are read from shared tables.'''
+
+    def __init__(self, converter_id, sorted_list, sparse_list, current_index):
+        self.sparse_list = sparse_list
+        self.sorted_list = sorted_list
+        self.domain_size = len(sorted_list)
+        self.converter_id = converter_id
+        self.current_index = current_index
+
+
+class _SharedInstance(Instance):
+    '''Instance whose BF and converter schedules are read from shared
+    tables. Converter schedules are used as stored and not recalculated.
+    '''
+
+    def __init__(self, properties, bf_schedules, converter_schedules):
+        for prop in PROBLEM_PROPERTIES:
+            setattr(self, _camel_to_snake(prop), properties[prop])
+        self._properties = properties
+        self.bf_schedules = bf_schedules
+        self.converter_schedules = converter_schedules
+        self.dur_emergency = self.tt_empty_buffer_to_bf + \
+            self.dur_bf + self.tt_bf_emergency_pit_empty_buffer
+        self._bf_orders = None
+
+
+class SharedInstance:
+    '''Owns or attaches to a shared memory block holding an instance
+    and its matrix with these int32 tables:
+
+        header          BF count, converter count, schedule count and
+                        the PROBLEM_PROPERTIES values
+        bf_schedules    bf_id, time, sulf_level per BF
+        converters      converter_id, time, depart_delay,
+                        min_early_arrival, max_sulf_level per converter
+        current         current index per converter
+        offsets         first schedule row per converter, plus the end
+        positions       sorted position of each BF per converter, or -1
+        schedules       Schedule fields per feasible schedule, sorted
+                        by converter and then by domain order
+    '''
+
+    @staticmethod
+    def create(instance: Instance, matrix):
+        '''Packs an instance and its matrix into a new shared memory block.
+        Current indices and schedule fields are copied as they are now.
+        '''
+        bf_count = len(instance.bf_schedules)
+        converter_count = len(matrix)
+        tables = dict((name, array('i')) for name in (
+            'bf_schedules', 'converters', 'current', 'offsets',
+            'positions', 'schedules'))
+        for bf in instance.bf_schedules:
+            tables['bf_schedules'].extend((bf.bf_id, bf.time, bf.sulf_level))
+        for converter in instance.converter_schedules:
+            tables['converters'].extend(converter.as_tuple())
+        schedules = tables['schedules']
+        for schedule_map in matrix:
+            tables['current'].append(schedule_map.current_index)
+            start = len(schedules)
+            tables['offsets'].append(start // _SCHEDULE_FIELDS)
+            schedules.fromlist(list(chain.from_iterable(
+                map(_schedule_fields, schedule_map.sorted_list))))
+            positions = array('i', [-1]) * bf_count
+            for index, bf_id in enumerate(schedules[start::_SCHEDULE_FIELDS]):
+                positions[bf_id] = index
+            tables['positions'].extend(positions)
+        tables['offsets'].append(len(schedules) // _SCHEDULE_FIELDS)
+
+        properties = instance.get_properties()
+        header = array('i', [bf_count, converter_count,
+                             len(schedules) // _SCHEDULE_FIELDS]
+                       + [properties[prop] for prop in PROBLEM_PROPERTIES])
+        size = len(header) + sum(len(table) for table in tables.values())
+        memory = shared_memory.SharedMemory(create=True, size=4 * max(1, size))
+        view = memory.buf.cast('i')
+        offset = 0
+        for table in [header] + list(tables.values()):
+            view[offset:offset + len(table)] = table
+            offset += len(table)
+        view.release()
+        return SharedInstance(memory)
+
+    @staticmethod
+    def attach(name):
+        '''Attaches to a block created by another process.'''
+        return SharedInstance(shared_memory.SharedMemory(name=name))
+
+    def __init__(self, memory):
+        self.memory = memory
+        self.name = memory.name
+        self._views = []
+        self._instance = None
+        self._matrix = None
+
+    def _slice(self, view, start, end):
+        '''Returns a zero-copy slice, tracked so close() can release it.'''
+        view = view[start:end]
+        self._views.append(view)
+        return view
+
+    def _get_tables(self):
+        words = self.memory.buf.cast('i')
+        view = words.toreadonly()
+        self._views.extend((words, view))
+        bf_count, converter_count, schedule_count = view[0:3]
+        sizes = [_HEADER, _BF_FIELDS * bf_count, _CONVERTER_FIELDS * converter_count,
+                 converter_count, converter_count + 1, converter_count * bf_count,
+                 _SCHEDULE_FIELDS * schedule_count]
+        tables = []
+        offset = 0
+        for size in sizes:
+            tables.append(self._slice(view, offset, offset + size))
+            offset += size
+        return tables
+
+    def get_instance(self):
+        '''Returns an instance that reads its schedules from the block.'''
+        if self._instance is None:
+            header, bf_table, converter_table = self._get_tables()[:3]
+
+            def _bf(index):
+                offset = index * _BF_FIELDS
+                return _BFSchedule(*bf_table[offset:offset + _BF_FIELDS])
+
+            def _converter(index):
+                offset = index * _CONVERTER_FIELDS
+                return _ConverterSchedule(
+                    *converter_table[offset:offset + _CONVERTER_FIELDS])
+
+            bf_count, converter_count = header[0], header[1]
+            properties = dict(zip(PROBLEM_PROPERTIES, header[3:].tolist()))
+            self._instance = _SharedInstance(
+                properties, _LazySequence(bf_count, _bf),
+                _LazySequence(converter_count, _converter))
+        return self._instance
+
+    def get_matrix(self):
+        '''Returns a matrix whose schedule maps are built on first access.
+        Only the current indices of the maps are private copies.
+        '''
+        if self._matrix is None:
+            header, _, _, current, offsets, positions, schedules = \
+                self._get_tables()
+            bf_count, converter_count = header[0], header[1]
+
+            def _schedule_map(converter_id):
+                start, end = offsets[converter_id], offsets[converter_id + 1]
+                sorted_list = _SortedRows(self._slice(
+                    schedules, start * _SCHEDULE_FIELDS, end * _SCHEDULE_FIELDS))
+                sparse_list = _SparseRows(self._slice(
+                    positions, converter_id * bf_count,
+                    (converter_id + 1) * bf_count), sorted_list)
+                return _SharedScheduleMap(converter_id, sorted_list, sparse_list,
+                                          current[converter_id])
+
+            self._matrix = _LazySequence(converter_count, _schedule_map)
+        return self._matrix
+
+    def close(self):
+        '''Detaches from the block. Objects already built from it stay
+        valid, but the instance and matrix can no longer build new ones.
+        '''
+        for view in reversed(self._views):
+            view.release()
+        self._views = []
+        self.memory.close()
+
+    def unlink(self):
+        '''Frees the block once every process has detached.'''
+        self.memory.unlink()
@@ -1,18 +1,53 @@
 '''Solution modeling.'''
+from array import array
+from bisect import bisect_left
+from itertools import accumulate, repeat
+from operator import add, mul, ge, le
 from instance import Instance
 from evaluator import *
 
+# State counts of a slot are packed contiguously, with
+# emergency runs counted in the column after the last state.
+_COLUMNS = STATE_COUNT + 1
+# Tie counts of the peak index saturate at the largest 'h' value.
+_MAX_TIES = 32767
+
+
+def _get_transits(instance: Instance, solution, matrix):
+    '''Returns the BF ids in transit from full buffer to desulf,
+    in BF order, for every slot with at least one such transit.
+    '''
+    transits = dict()
+    offset = instance.tt_empty_buffer_to_bf + instance.dur_bf \
+        + instance.tt_bf_to_full_buffer
+    for bf_id, converter_id in enumerate(solution):
+        if converter_id == -1:
+            continue
+        schedule = matrix[converter_id].sparse_list[bf_id]
+        start = schedule.start_time + offset + schedule.buffer_duration
+        for slot in range(start, start + instance.tt_full_buffer_to_desulf):
+            transits.setdefault(slot, []).append(bf_id)
+    return transits
+
 
 def resolve_conflicts(instance: Instance, solution, matrix):
     '''Attempt to resolve full buffer to desulf conflicts.'''
-    timeline = create_solution_timeline(instance, solution, matrix)
-    length = len(timeline)
+    # Only transit slots are materialized; the scan jumps over the rest.
+    transits = _get_transits(instance, solution, matrix)
+    slots = sorted(transits)
     i = 0
     current_count = 0
     current_bf = -1
-    while i < length:
-        slot = timeline[i]
-        in_transit = [t[0] for t in slot if t[1] == T_FULL_TO_DESULF]
+    while True:
+        in_transit = transits.get(i)
+        if in_transit is None:
+            position = bisect_left(slots, i)
+            if position == len(slots):
+                break
+            i = slots[position]
+            current_bf = -1
+            current_count = 0
+            continue
         count_in_transit = len(in_transit)
         if count_in_transit > 2:
             raise Exception(
@@ -40,91 +75,470 @@ def resolve_conflicts(instance: Instance, solution, matrix):
             current_bf = -1
             current_count = 0
             continue
-        elif count_in_transit == 1:
+        else:
             current_bf = in_transit[0]
             current_count += 1
-        else:
-            current_bf = -1
-            current_count = 0
 
         i += 1
 
 
+def _subtract_intervals(start, end, released):
+    '''Returns the pieces of [start, end) not covered by released spans.'''
+    pieces = [(start, end)]
+    for released_start, released_end in released:
+        remaining = []
+        for piece_start, piece_end in pieces:
+            if released_start > piece_start:
+                remaining.append((piece_start, min(piece_end, released_start)))
+            if released_end < piece_end:
+                remaining.append((max(piece_start, released_end), piece_end))
+        pieces = [piece for piece in remaining if piece[0] < piece[1]]
+    return pieces
+
+
+def _merge_windows(spans):
+    '''Merges (start, end) spans into sorted disjoint windows.'''
+    windows = []
+    for start, end in sorted(spans):
+        if len(windows) > 0 and start <= windows[-1][1]:
+            if end > windows[-1][1]:
+                windows[-1] = windows[-1][0], end
+        else:
+            windows.append((start, end))
+    return windows
+
+
+def _net_increase(added, removed):
+    '''Returns the (start, end, delta) pieces where more added than
+    removed (start, end) spans overlap, with the net count as delta.
+    '''
+    events = [(start, 1) for start, end in added] \
+        + [(end, -1) for start, end in added] \
+        + [(start, -1) for start, end in removed] \
+        + [(end, 1) for start, end in removed]
+    events.sort()
+    pieces = []
+    delta = 0
+    previous = None
+    for time, change in events:
+        if delta > 0 and time > previous:
+            pieces.append((previous, time, delta))
+        delta += change
+        previous = time
+    return pieces
+
+
+def _is_feasible(conflict_map, new_conflict_map, max_torpedoes=0,
+                 new_max_torpedoes=0):
+    '''Check that neither the torpedo count nor the conflicts of any
+    state rise, except for full buffer to desulf transit conflicts,
+    which resolve_conflicts repairs.
+    '''
+    if new_max_torpedoes > max_torpedoes:
+        return False
+    for i, state in enumerate(new_conflict_map):
+        if i == T_FULL_TO_DESULF:
+            continue
+        elif state > conflict_map[i]:
+            return False
+    return True
+
+
+class _SaturationIndex:
+    '''Answers whether a state is at or above capacity somewhere in
+    a range of slots, and counts the over capacity slots of each state.
+    Ranges are checked on a slice of the state column, which needs no
+    index to build or maintain and is as fast as a tree for the short
+    ranges of a trip.
+    '''
+
+    def __init__(self, timeline, max_states):
+        self.timeline = timeline
+        self.size = len(timeline) // _COLUMNS
+        self.max_states = max_states
+        self.overloaded = [0 for state in range(STATE_COUNT)]
+        for state, max_state in enumerate(max_states):
+            column = timeline[state::_COLUMNS]
+            self.overloaded[state] = len(column) \
+                - sum(column.count(count) for count in range(max_state + 1))
+
+    def any(self, state, start, end):
+        '''Check whether a state is saturated in any slot of [start, end).'''
+        start, end = max(start, 0), min(end, self.size)
+        if start >= end:
+            return False
+        column = self.timeline[start * _COLUMNS + state:end * _COLUMNS:_COLUMNS]
+        return max(column) >= self.max_states[state]
+
+
+class _PeakIndex:
+    '''Segment tree over the torpedo count of each slot, supporting
+    range increments and range maximum queries in O(log T). Every node
+    also counts the slots of its range that reach the maximum, up to
+    _MAX_TIES. The tree is laid out bottom-up with the slots as leaves
+    size to 2 * size - 1, so nothing is padded to a power of two and
+    the root still covers every slot.
+    '''
+
+    def __init__(self, timeline):
+        size = len(timeline) // _COLUMNS
+        self.size = size
+        self.height = size.bit_length()
+        self.pending = array('h', bytes(2 * size))
+        self.peaks = array('h', bytes(2 * size))
+        self.peaks.extend(map(sum, zip(*[timeline[column::_COLUMNS]
+                                          for column in range(_COLUMNS)])))
+        self.ties = array('h', bytes(2 * size))
+        self.ties.extend(array('h', [1]) * size)
+        # Build the nodes in blocks whose children all lie above the
+        # block, as _update would for each node, with nothing pending yet.
+        peaks, ties = self.peaks, self.ties
+        end = size
+        while end > 1:
+            start = (end + 1) // 2
+            left = peaks[2 * start:2 * end:2]
+            right = peaks[2 * start + 1:2 * end:2]
+            left_ties = map(mul, ties[2 * start:2 * end:2], map(ge, left, right))
+            right_ties = map(mul, ties[2 * start + 1:2 * end:2], map(le, left, right))
+            peaks[start:end] = array('h', map(max, left, right))
+            ties[start:end] = array('h', map(min, map(add, left_ties, right_ties),
+                                             repeat(_MAX_TIES)))
+            end = start
+
+    def _apply(self, node, value):
+        self.peaks[node] += value
+        if node < self.size:
+            self.pending[node] += value
+
+    def _update(self, node):
+        peaks = self.peaks
+        left, right = peaks[2 * node], peaks[2 * node + 1]
+        if left > right:
+            peaks[node] = left + self.pending[node]
+            self.ties[node] = self.ties[2 * node]
+        elif left < right:
+            peaks[node] = right + self.pending[node]
+            self.ties[node] = self.ties[2 * node + 1]
+        else:
+            peaks[node] = left + self.pending[node]
+            self.ties[node] = min(self.ties[2 * node] + self.ties[2 * node + 1],
+                                  _MAX_TIES)
+
+    def _pull(self, node):
+        while node > 1:
+            node >>= 1
+            self._update(node)
+
+    def _push(self, node):
+        pending = self.pending
+        for shift in range(self.height, 0, -1):
+            parent = node >> shift
+            value = pending[parent]
+            if value != 0:
+                self._apply(2 * parent, value)
+                self._apply(2 * parent + 1, value)
+                pending[parent] = 0
+
+    def _cover(self, start, end):
+        '''Returns the nodes covering [start, end) from left to right,
+        with the pending values above them pushed down.
+        '''
+        left, right = start + self.size, end + self.size
+        self._push(left)
+        self._push(right - 1)
+        nodes, right_nodes = [], []
+        while left < right:
+            if left & 1:
+                nodes.append(left)
+                left += 1
+            if right & 1:
+                right -= 1
+                right_nodes.append(right)
+            left >>= 1
+            right >>= 1
+        nodes.extend(reversed(right_nodes))
+        return nodes
+
+    def add(self, start, end, value):
+        '''Add value to the torpedo count of every slot in [start, end).'''
+        if start >= end:
+            return
+        left, right = start + self.size, end + self.size
+        first, last = left, right - 1
+        while left < right:
+            if left & 1:
+                self._apply(left, value)
+                left += 1
+            if right & 1:
+                right -= 1
+                self._apply(right, value)
+            left >>= 1
+            right >>= 1
+        self._pull(first)
+        self._pull(last)
+
+    def max(self, start, end):
+        '''Returns the maximum torpedo count in [start, end).'''
+        if start >= end:
+            return 0
+        left, right = start + self.size, end + self.size
+        self._push(left)
+        self._push(right - 1)
+        peaks = self.peaks
+        result = 0
+        while left < right:
+            if left & 1:
+                result = max(result, peaks[left])
+                left += 1
+            if right & 1:
+                right -= 1
+                result = max(result, peaks[right])
+            left >>= 1
+            right >>= 1
+        return result
+
+    def peak(self):
+        '''Returns the maximum torpedo count and the number of slots with it.'''
+        return self.peaks[1], self.ties[1]
+
+    def argmax(self):
+        '''Returns the first slot with the maximum torpedo count.'''
+        peaks = self.peaks
+        pending = self.pending
+        # The root covers every slot, but only the covering nodes keep
+        # their slots in order.
+        target = peaks[1]
+        node = next(node for node in self._cover(0, self.size)
+                    if peaks[node] == target)
+        while node < self.size:
+            target = peaks[node] - pending[node]
+            node *= 2
+            if peaks[node] != target:
+                node += 1
+        return node - self.size
+
+
 class ConflictTimeline:
     '''Maintains and mutates a conflict timeline.'''
 
     @staticmethod
-    def create(instance: Instance, solution, matrix):
-        '''Create a timeline with state distribution
-        for each time slot of the instance.
+    def create(instance: Instance, solution, matrix, window=None):
+        '''Create a timeline with state distribution for each time
+        slot of the instance, or only for the slots of a (start, end)
+        window. Times passed to a window timeline stay absolute.
         '''
-        timeline = timeline = [[0, 0, 0, 0, 0, 0, 0, 0, 0, 0]
-                               for t in range(instance.get_latest_time() + 1)]
+        trips = []
         for bf_id, converter_id in enumerate(solution):
             if converter_id == -1:
-                start_time, schedule_timeline \
-                    = create_emergency_timeline(instance, bf_id)
-                i = start_time
-                for state in schedule_timeline:
-                    timeline[i][state] += 1
-                    i += 1
+                trips.append(get_emergency_intervals(instance, bf_id))
             else:
                 schedule = matrix[converter_id].sparse_list[bf_id]
-                schedule_timeline \
-                    = create_schedule_timeline(instance, schedule)
-                i = schedule.start_time
-                for state in schedule_timeline:
-                    timeline[i][state] += 1
-                    i += 1
-        return ConflictTimeline(instance, timeline)
-
-    def __init__(self, instance: Instance, timeline):
+                trips.append(get_schedule_intervals(instance, schedule))
+
+        origin, size = 0, instance.get_latest_time() + 1
+        if window is not None:
+            origin, size = window[0], window[1] - window[0]
+        deltas = [array('i', bytes(4 * (size + 1)))
+                  for column in range(_COLUMNS)]
+        for intervals in trips:
+            for state, start, end in intervals:
+                start, end = max(start - origin, 0), min(end - origin, size)
+                if start < end:
+                    delta = deltas[state]
+                    delta[start] += 1
+                    delta[end] -= 1
+
+        timeline = array('h', bytes(2 * size * _COLUMNS))
+        for column, delta in enumerate(deltas):
+            timeline[column::_COLUMNS] = array('h', accumulate(delta[:size]))
+        return ConflictTimeline(instance, timeline, origin)
+
+    def __init__(self, instance: Instance, timeline, origin=0):
         self.instance = instance
         self.timeline = timeline
+        self.origin = origin
+        self.size = len(timeline) // _COLUMNS
         self.max_states = get_state_constraints(instance)
+        self.saturation = _SaturationIndex(timeline, self.max_states)
+        self.peaks = _PeakIndex(timeline)
 
     def count_conflicts(self, start=0, end=-1):
         '''Calculate conflict distribution and torpedo count for a timeline.'''
         timeline = self.timeline
-        max_states = self.max_states
-        max_torpedoes = 0
+        start = max(start - self.origin, 0)
+        end = self.size if end < 0 else end - self.origin
+        if start >= end:
+            return [0 for t in range(STATE_COUNT)], 0
         conflict_map = [0 for t in range(STATE_COUNT)]
-        if end < 0:
-            end = len(timeline)
-        for slot in range(start, end):
-            time = timeline[slot]
-            max_torpedoes = max(max_torpedoes, sum(time))
-            for i, max_state in enumerate(max_states):
-                if time[i] > max_state:
-                    conflict_map[i] += 1
-        return conflict_map, max_torpedoes
+        for i, max_state in enumerate(self.max_states):
+            column = timeline[start * _COLUMNS + i:end * _COLUMNS:_COLUMNS]
+            conflict_map[i] = len(column) \
+                - sum(column.count(count) for count in range(max_state + 1))
+        return conflict_map, self.peaks.max(start, end)
+
+    def peak(self):
+        '''Returns the maximum torpedo count and the number of slots with it.'''
+        return self.peaks.peak()
+
+    def peak_slot(self):
+        '''Returns the first slot with the maximum torpedo count.'''
+        return self.peaks.argmax() + self.origin
+
+    def get_segment(self, start, end):
+        '''Returns a copy of the state counts for slots in [start, end).'''
+        start, end = start - self.origin, end - self.origin
+        return self.timeline[start * _COLUMNS:end * _COLUMNS]
+
+    def set_segment(self, start, segment):
+        '''Overwrites state counts from a segment starting at slot start.
+        Indexes are not updated, so a new ConflictTimeline should be
+        created after all segments are merged.
+        '''
+        offset = (start - self.origin) * _COLUMNS
+        self.timeline[offset:offset + len(segment)] = segment
+
+    def is_saturated(self, trips, released=()):
+        '''Check whether adding trips, given as lists of (state, start, end)
+        intervals, is bound to create a new conflict or raise the torpedo
+        peak of a trip window. Slots covered by a released trip are
+        skipped, since that trip is about to be removed. States that are
+        over capacity somewhere are skipped as well, because removals may
+        offset the new conflict.
+        '''
+        saturation = self.saturation
+        overloaded = saturation.overloaded
+        origin = self.origin
+        released_spans = [(trip[0][1], trip[-1][2]) for trip in released]
+        released_states = [[] for state in range(STATE_COUNT)]
+        for trip in released:
+            for state, start, end in trip:
+                if state != EMERGENCY:
+                    released_states[state].append((start, end))
+
+        for trip in trips:
+            start, end = trip[0][1], trip[-1][2]
+            peak = self.peaks.max(start - origin, end - origin)
+            for piece_start, piece_end \
+                    in _subtract_intervals(start, end, released_spans):
+                if self.peaks.max(piece_start - origin, piece_end - origin) >= peak:
+                    return True
+
+        for trip in trips:
+            for state, start, end in trip:
+                if state == EMERGENCY or state == T_FULL_TO_DESULF \
+                        or overloaded[state] > 0:
+                    continue
+                for piece_start, piece_end in _subtract_intervals(
+                        start, end, released_states[state]):
+                    if saturation.any(state, piece_start - origin,
+                                      piece_end - origin):
+                        return True
+        return False
+
+    def check_move(self, trips, released, windows):
+        '''Decides from the net change of every slot whether replacing
+        the released trips by trips, both given as lists of (state, start,
+        end) intervals, keeps the torpedo peak and the conflicts of each
+        of the disjoint (start, end) windows from rising. Unlike the
+        hill_climb moves, no full buffer to desulf transit may be added
+        to an occupied slot. Returns None if a state that is over
+        capacity, or that gains two or more trips in a slot below
+        capacity, needs a full evaluation.
+        '''
+        peaks = self.peaks
+        origin = self.origin
+        window_peaks = dict()
+        for start, end, delta in _net_increase(
+                [(trip[0][1], trip[-1][2]) for trip in trips],
+                [(trip[0][1], trip[-1][2]) for trip in released]):
+            window = next(window for window in windows
+                          if window[0] <= start and end <= window[1])
+            if window not in window_peaks:
+                window_peaks[window] = peaks.max(window[0] - origin,
+                                                 window[1] - origin)
+            if peaks.max(start - origin, end - origin) + delta \
+                    > window_peaks[window]:
+                return False
+
+        added_states = [[] for state in range(STATE_COUNT)]
+        released_states = [[] for state in range(STATE_COUNT)]
+        for trip_list, states in ((trips, added_states), (released, released_states)):
+            for trip in trip_list:
+                for state, start, end in trip:
+                    if state != EMERGENCY:
+                        states[state].append((start, end))
+
+        saturation = self.saturation
+        result = True
+        for state, max_state in enumerate(self.max_states):
+            if len(added_states[state]) == 0:
+                continue
+            # resolve_conflicts can only repair some transit conflicts,
+            # so no transit may enter an occupied slot.
+            strict = state == T_FULL_TO_DESULF
+            for start, end, delta in _net_increase(
+                    added_states[state], released_states[state]):
+                if saturation.overloaded[state] > 0 and not strict:
+                    result = None
+                elif delta > max_state:
+                    return False
+                elif delta == 1 and saturation.any(state, start - origin,
+                                                   end - origin):
+                    return False
+                elif delta > 1:
+                    result = None
+        return result
 
     def add(self, time, state_list):
         timeline = self.timeline
+        max_states = self.max_states
+        saturation = self.saturation
+        time -= self.origin
+        self.peaks.add(time, time + len(state_list), 1)
+        offset = time * _COLUMNS
         for state in state_list:
-            timeline[time][state] += 1
-            time += 1
+            if state == EMERGENCY:
+                timeline[offset + STATE_COUNT] += 1
+            else:
+                index = offset + state
+                count = timeline[index] + 1
+                timeline[index] = count
+                if count == max_states[state] + 1:
+                    saturation.overloaded[state] += 1
+            offset += _COLUMNS
 
     def subtract(self, time, state_list):
         timeline = self.timeline
+        max_states = self.max_states
+        saturation = self.saturation
+        time -= self.origin
+        self.peaks.add(time, time + len(state_list), -1)
+        offset = time * _COLUMNS
         for state in state_list:
-            timeline[time][state] -= 1
-            time += 1
+            if state == EMERGENCY:
+                timeline[offset + STATE_COUNT] -= 1
+            else:
+                index = offset + state
+                count = timeline[index] - 1
+                timeline[index] = count
+                if count == max_states[state]:
+                    saturation.overloaded[state] -= 1
+            offset += _COLUMNS
 
 
-def hill_climb(instance: Instance, solution, matrix, max_lookahead=32):
-    '''Minimizes desulf duration without causing new conflicts.'''
-    timeline = ConflictTimeline.create(instance, solution, matrix)
+def hill_climb(instance: Instance, solution, matrix, max_lookahead=32,
+               window=None, timeline=None, telemetry=None, converters=None):
+    '''Minimizes desulf duration without causing new conflicts.
+    When a (start, end) window is given, only trips that lie entirely
+    inside it are moved. When converter ids are given, only moves of
+    their current trips are tried. Progress is reported to telemetry
+    if given.
+    '''
+    if timeline is None:
+        timeline = ConflictTimeline.create(instance, solution, matrix)
 
-    def _is_feasible(conflict_map, new_conflict_map, max_torpedoes, new_max_torpedoes):
-        if new_max_torpedoes > max_torpedoes:
-            return False
-        for i, state in enumerate(new_conflict_map):
-            if i == T_FULL_TO_DESULF:
-                continue
-            elif state > conflict_map[i]:
-                return False
-        return True
+    def _in_window(start, end):
+        return window is None or (window[0] <= start and end <= window[1])
 
     def _try_update_timeline(c1, tc1, n1, tn1, c2, tc2, n2, tn2):
         ec1, en1, ec2, en2 = tc1 + \
@@ -160,6 +574,18 @@ def hill_climb(instance: Instance, solution, matrix, max_lookahead=32):
             return False
 
     def _try_swap_emergency(curr1, new1):
+        if window is not None and not (
+                _in_window(*instance.get_emergency_interval(curr1.bf_id)[:2])
+                and _in_window(*instance.get_emergency_interval(new1.bf_id)[:2])):
+            return False
+
+        if timeline.is_saturated(
+                [get_schedule_intervals(instance, new1),
+                 get_emergency_intervals(instance, curr1.bf_id)],
+                [get_schedule_intervals(instance, curr1),
+                 get_emergency_intervals(instance, new1.bf_id)]):
+            return False
+
         c1 = create_schedule_timeline(instance, curr1)
         n1 = create_schedule_timeline(instance, new1)
         tc2, c2 = create_emergency_timeline(instance, new1.bf_id)
@@ -173,7 +599,8 @@ def hill_climb(instance: Instance, solution, matrix, max_lookahead=32):
             return False
 
     def _try_swap(curr1, new1):
-        if curr1 is new1 or not new1.is_pullable:
+        if curr1 is new1 or not new1.is_pullable \
+                or not _in_window(new1.start_time, new1.end_time):
             return False
 
         gain1 = curr1.desulf_duration - new1.desulf_duration
@@ -190,10 +617,22 @@ def hill_climb(instance: Instance, solution, matrix, max_lookahead=32):
             return False
 
         curr2 = schedule_map2.sparse_list[new1.bf_id]
+        if not (_in_window(new2.start_time, new2.end_time)
+                and _in_window(curr2.start_time, curr2.end_time)):
+            return False
+
         gain2 = curr2.desulf_duration - new2.desulf_duration
         if gain1 + gain2 <= 0:
             return False
 
+        # Reject early when a new trip enters a full slot or raises the peak.
+        if timeline.is_saturated(
+                [get_schedule_intervals(instance, new1),
+                 get_schedule_intervals(instance, new2)],
+                [get_schedule_intervals(instance, curr1),
+                 get_schedule_intervals(instance, curr2)]):
+            return False
+
         c1 = create_schedule_timeline(instance, curr1)
         n1 = create_schedule_timeline(instance, new1)
         c2 = create_schedule_timeline(instance, curr2)
@@ -202,7 +641,7 @@ def hill_climb(instance: Instance, solution, matrix, max_lookahead=32):
                                 c2, curr2.start_time, n2, new2.start_time):
             solution[curr1.bf_id] = converter2
             solution[new1.bf_id] = converter1
-            schedule_map2.current_index = new2.index
+            schedule_map2.set_current_schedule(new2)
             return True
         else:
             return False
@@ -212,12 +651,25 @@ def hill_climb(instance: Instance, solution, matrix, max_lookahead=32):
     else:
         max_lookahead = min(len(instance.bf_schedules) - 1, max_lookahead)
 
+    # Swaps only move converters to trips inside the window, so a
+    # converter outside of it never enters it and can be left out.
+    if converters is None:
+        converters = range(len(matrix))
+    schedule_maps = [matrix[converter_id] for converter_id in converters]
+    if window is not None:
+        currents = [schedule_map.get_current_schedule()
+                    for schedule_map in schedule_maps]
+        schedule_maps = [schedule_map for schedule_map, current
+                         in zip(schedule_maps, currents)
+                         if _in_window(current.start_time, current.end_time)]
+
     lookahead = 1
+    passes = 0
     loop = True
     while loop:
         while True:
             updates = 0
-            for schedule_map in matrix:
+            for schedule_map in schedule_maps:
                 domain = schedule_map.sorted_list
                 domain_size = len(domain)
                 current_index = schedule_map.current_index
@@ -230,6 +682,16 @@ def hill_climb(instance: Instance, solution, matrix, max_lookahead=32):
                         updates += 1
                         break
 
+            passes += 1
+            if telemetry is not None and telemetry.is_due():
+                conflicts, torpedo_count = timeline.count_conflicts()
+                telemetry.emit('pass', passes=passes, lookahead=lookahead,
+                               updates=updates,
+                               desulf_time=calculate_desulf_time(
+                                   solution, matrix),
+                               torpedo_count=torpedo_count,
+                               conflicts=conflicts)
+
             if updates == 0:
                 break
 
@@ -241,6 +703,282 @@ def hill_climb(instance: Instance, solution, matrix, max_lookahead=32):
     return timeline
 
 
+def reduce_peak(instance: Instance, solution, matrix, timeline=None, telemetry=None,
+                max_lookahead=32):
+    '''Minimizes the torpedo count by exchanging trips that cover the
+    slots at the peak, without causing new conflicts. Every accepted
+    move lowers the number of peak slots, and a peak level is only kept
+    if all of its slots could be lowered. Like hill_climb, only the
+    first max_lookahead schedules after the current one of a domain are
+    tried. If the torpedo count dropped, desulf time is minimized again
+    with hill_climb.
+    '''
+    if timeline is None:
+        timeline = ConflictTimeline.create(instance, solution, matrix)
+    torpedo_count = timeline.peak()[0]
+
+    def _try_move(removed, added):
+        windows = [(start, start + len(states))
+                   for start, states in removed + added]
+        state_before = [timeline.count_conflicts(start, end)[0]
+                        for start, end in windows]
+        peak, ties = timeline.peak()
+        for start, states in removed:
+            timeline.subtract(start, states)
+        for start, states in added:
+            timeline.add(start, states)
+        new_peak, new_ties = timeline.peak()
+        if new_peak < peak or (new_peak == peak and new_ties < ties):
+            state_after = [timeline.count_conflicts(start, end)[0]
+                           for start, end in windows]
+            if all(_is_feasible(conflicts, new_conflicts) for conflicts, new_conflicts
+                   in zip(state_before, state_after)):
+                return True
+        for start, states in added:
+            timeline.subtract(start, states)
+        for start, states in removed:
+            timeline.add(start, states)
+        return False
+
+    def _trip(schedule):
+        return schedule.start_time, create_schedule_timeline(instance, schedule)
+
+    def _covers(start, end, slot):
+        return 1 if start <= slot < end else 0
+
+    def _lower_slot(slot):
+        for converter1, schedule_map1 in enumerate(matrix):
+            curr1 = schedule_map1.get_current_schedule()
+            if curr1 is None or not curr1.start_time <= slot < curr1.end_time:
+                continue
+            domain = schedule_map1.sorted_list
+            for new1 in domain[:min(len(domain), curr1.index + 1 + max_lookahead)]:
+                if new1 is curr1 or not new1.is_pullable:
+                    continue
+                covered = _covers(new1.start_time, new1.end_time, slot)
+                converter2 = solution[new1.bf_id]
+                if converter2 == -1:
+                    # Emergency conversion of the current BF.
+                    emergency1 = instance.get_emergency_interval(curr1.bf_id)
+                    emergency2 = instance.get_emergency_interval(new1.bf_id)
+                    if covered + _covers(emergency1[0], emergency1[1], slot) \
+                            >= 1 + _covers(emergency2[0], emergency2[1], slot):
+                        continue
+                    if _try_move([_trip(curr1),
+                                  create_emergency_timeline(instance, new1.bf_id)],
+                                 [_trip(new1),
+                                  create_emergency_timeline(instance, curr1.bf_id)]):
+                        solution[curr1.bf_id] = -1
+                        solution[new1.bf_id] = converter1
+                        schedule_map1.set_current_schedule(new1)
+                        return True
+                    continue
+
+                schedule_map2 = matrix[converter2]
+                new2 = schedule_map2.sparse_list[curr1.bf_id]
+                if new2 is None or not new2.is_pullable:
+                    continue
+                curr2 = schedule_map2.sparse_list[new1.bf_id]
+                if covered + _covers(new2.start_time, new2.end_time, slot) \
+                        >= 1 + _covers(curr2.start_time, curr2.end_time, slot):
+                    continue
+                if _try_move([_trip(curr1), _trip(curr2)],
+                             [_trip(new1), _trip(new2)]):
+                    solution[curr1.bf_id] = converter2
+                    solution[new1.bf_id] = converter1
+                    schedule_map1.set_current_schedule(new1)
+                    schedule_map2.set_current_schedule(new2)
+                    return True
+        return False
+
+    while True:
+        peak, ties = timeline.peak()
+        saved_solution = list(solution)
+        saved_indices = [schedule_map.current_index for schedule_map in matrix]
+        saved_timeline = timeline.get_segment(0, timeline.size)
+        while timeline.peak()[0] == peak:
+            if not _lower_slot(timeline.peak_slot()):
+                break
+
+        if timeline.peak()[0] < peak:
+            if telemetry is not None:
+                telemetry.emit('peak', torpedo_count=timeline.peak()[0],
+                               desulf_time=calculate_desulf_time(solution, matrix))
+            continue
+
+        # The level could not be cleared, undo its moves.
+        solution[:] = saved_solution
+        for schedule_map, index in zip(matrix, saved_indices):
+            schedule_map.current_index = index
+        timeline = ConflictTimeline(instance, saved_timeline)
+        if peak < torpedo_count:
+            timeline = hill_climb(instance, solution, matrix,
+                                  timeline=timeline, telemetry=telemetry)
+        return timeline
+
+
+def compound_climb(instance: Instance, solution, matrix, max_lookahead=8,
+                   chain_length=3, timeline=None, telemetry=None, verify=False):
+    '''Minimizes desulf duration with compound moves that hill_climb
+    cannot make. In a cycle, three or more converters each take the BF
+    of the next one. In an ejection chain, two or more converters shift
+    along to an emergency BF and the first BF becomes an emergency run.
+    Chains span at most chain_length converters. Conflicts and torpedo
+    peaks of a chain are counted once per merged window of its trips,
+    and most chains are decided from the net change per slot alone, so
+    a chain costs about as much to evaluate as a pair swap. With verify,
+    every chain is also evaluated in full, and an exception is raised
+    if the net change accepted a chain that the full evaluation rejects.
+    Returns the timeline and the number of chains evaluated.
+    '''
+    if timeline is None:
+        timeline = ConflictTimeline.create(instance, solution, matrix)
+    if max_lookahead < 0:
+        max_lookahead = len(instance.bf_schedules)
+    evaluated = 0
+
+    def _try_chain(chain, emergency_bf):
+        nonlocal evaluated
+        evaluated += 1
+        first_bf = chain[0][1].bf_id
+        removed = [get_schedule_intervals(instance, curr) for _, curr, _ in chain]
+        added = [get_schedule_intervals(instance, new) for _, _, new in chain]
+        if emergency_bf is not None:
+            removed.append(get_emergency_intervals(instance, emergency_bf))
+            added.append(get_emergency_intervals(instance, first_bf))
+        windows = _merge_windows([(trip[0][1], trip[-1][2])
+                                  for trip in removed + added])
+        feasible = timeline.check_move(added, removed, windows)
+        if feasible is False:
+            return False
+
+        removed_states = [(curr.start_time, create_schedule_timeline(instance, curr))
+                          for _, curr, _ in chain]
+        added_states = [(new.start_time, create_schedule_timeline(instance, new))
+                        for _, _, new in chain]
+        if emergency_bf is not None:
+            removed_states.append(create_emergency_timeline(instance, emergency_bf))
+            added_states.append(create_emergency_timeline(instance, first_bf))
+
+        if feasible is None or verify:
+            state_before = [timeline.count_conflicts(start, end)
+                            for start, end in windows]
+        for start, states in removed_states:
+            timeline.subtract(start, states)
+        for start, states in added_states:
+            timeline.add(start, states)
+        if feasible is None or verify:
+            state_after = [timeline.count_conflicts(start, end)
+                           for start, end in windows]
+            accepted = all(
+                _is_feasible(conflicts, new_conflicts, torpedoes, new_torpedoes)
+                for (conflicts, torpedoes), (new_conflicts, new_torpedoes)
+                in zip(state_before, state_after))
+            if feasible and not accepted:
+                raise Exception('check_move accepted a chain of BFs {} that '
+                                'full evaluation rejects'.format(
+                                    [curr.bf_id for _, curr, _ in chain]))
+            feasible = accepted
+        if feasible:
+            if emergency_bf is not None:
+                solution[first_bf] = -1
+            for converter_id, _, new in chain:
+                solution[new.bf_id] = converter_id
+                matrix[converter_id].set_current_schedule(new)
+            return True
+
+        for start, states in added_states:
+            timeline.subtract(start, states)
+        for start, states in removed_states:
+            timeline.add(start, states)
+        return False
+
+    def _extend(chain, used, gain):
+        '''Extends a chain of (converter_id, current, new) steps depth
+        first and applies the first improving feasible move.
+        '''
+        new = chain[-1][2]
+        converter_id = solution[new.bf_id]
+        if converter_id == -1:
+            # A single step to an emergency BF is a hill_climb move.
+            return len(chain) >= 2 and gain > 0 and _try_chain(chain, new.bf_id)
+        if len(chain) >= chain_length:
+            return False
+
+        schedule_map = matrix[converter_id]
+        curr = schedule_map.sparse_list[new.bf_id]
+        closing = schedule_map.sparse_list[chain[0][1].bf_id]
+        if len(chain) >= 2 and closing is not None and closing.is_pullable \
+                and gain + curr.desulf_duration - closing.desulf_duration > 0 \
+                and _try_chain(chain + [(converter_id, curr, closing)], None):
+            return True
+
+        # The last step of a chain can only end on an emergency BF.
+        last = len(chain) + 1 == chain_length
+        domain = schedule_map.sorted_list
+        for candidate in domain[:min(len(domain), curr.index + 1 + max_lookahead)]:
+            new_gain = gain + curr.desulf_duration - candidate.desulf_duration
+            if candidate.bf_id in used or not candidate.is_pullable or (
+                    last and (solution[candidate.bf_id] != -1 or new_gain <= 0)):
+                continue
+            used.add(candidate.bf_id)
+            found = _extend(chain + [(converter_id, curr, candidate)], used, new_gain)
+            used.discard(candidate.bf_id)
+            if found:
+                return True
+        return False
+
+    passes = 0
+    while True:
+        updates = 0
+        for converter_id, schedule_map in enumerate(matrix):
+            curr1 = schedule_map.get_current_schedule()
+            if curr1 is None:
+                continue
+            domain = schedule_map.sorted_list
+            for new1 in domain[:min(len(domain), curr1.index + 1 + max_lookahead)]:
+                if new1 is curr1 or not new1.is_pullable:
+                    continue
+                if _extend([(converter_id, curr1, new1)], {curr1.bf_id, new1.bf_id},
+                           curr1.desulf_duration - new1.desulf_duration):
+                    updates += 1
+                    break
+
+        passes += 1
+        if telemetry is not None and telemetry.is_due():
+            conflicts, torpedo_count = timeline.count_conflicts()
+            telemetry.emit('compound', passes=passes, updates=updates,
+                           evaluated=evaluated,
+                           desulf_time=calculate_desulf_time(solution, matrix),
+                           torpedo_count=torpedo_count, conflicts=conflicts)
+        if updates == 0:
+            return timeline, evaluated
+
+
+def optimize(instance: Instance, solution, matrix, timeline, telemetry=None,
+             phase=None):
+    '''Improves a hill climbed solution with reduce_peak and
+    compound_climb, then resolves remaining transit conflicts. If
+    given, phase is called with a message and a phase name before each
+    step. Returns the timeline and the number of compound moves
+    evaluated.
+    '''
+    if phase is None:
+        def phase(message, name):
+            pass
+    phase('Reducing torpedo count...', 'reduce_peak')
+    timeline = reduce_peak(instance, solution, matrix, timeline, telemetry)
+    phase('Applying compound moves...', 'compound')
+    timeline, evaluated = compound_climb(instance, solution, matrix,
+                                         timeline=timeline, telemetry=telemetry)
+    conflicts, torpedo_count = timeline.count_conflicts()
+    if sum(conflicts) > 0:
+        phase('Resolving conflicts...', 'resolve_conflicts')
+        resolve_conflicts(instance, solution, matrix)
+        timeline = ConflictTimeline.create(instance, solution, matrix)
+    return timeline, evaluated
+
+
 def find_initial_solution(instance: Instance):
     '''Finds an initial solution using greedy search.
     The initial solution guarantees that no deadline is missed,
@@ -0,0 +1,102 @@
+'''What-if sweeps over problem properties.'''
+import os
+from itertools import product, groupby, chain
+from concurrent.futures import ProcessPoolExecutor
+from instance import Instance, PROBLEM_PROPERTIES, CAPACITY_PROPERTIES
+from daemon import WarmInstance, solve_warm
+
+_base_properties = None
+
+
+def parse_grid(args):
+    '''Parses "property=value,value,..." arguments into a grid.
+    Raises ValueError for malformed arguments.
+    '''
+    grid = []
+    for arg in args:
+        prop, _, values = arg.partition('=')
+        if prop not in PROBLEM_PROPERTIES:
+            raise ValueError('Unknown property {}'.format(prop))
+        try:
+            grid.append((prop, [int(value) for value in values.split(',')]))
+        except ValueError:
+            raise ValueError('Invalid values for {}: "{}"'.format(prop, values))
+    return grid
+
+
+def get_variants(grid):
+    '''Returns the override dictionary of every grid point. Variants that
+    share the properties get_distance depends on are listed together.
+    '''
+    variants = [dict(zip([prop for prop, _ in grid], values))
+                for values in product(*[values for _, values in grid])]
+    variants.sort(key=_get_distance_key)
+    return variants
+
+
+def _get_distance_key(overrides):
+    return tuple(sorted((prop, value) for prop, value in overrides.items()
+                        if prop not in CAPACITY_PROPERTIES))
+
+
+def _split_variants(variants, workers):
+    '''Groups sorted variants by distance key, so that a task builds
+    its matrix once. Groups are split into chunks when there are
+    fewer groups than workers.
+    '''
+    groups = [list(group) for _, group
+              in groupby(variants, key=_get_distance_key)]
+    if len(groups) >= workers:
+        return groups
+    chunk_size = max(1, -(-len(variants) // workers))
+    return [group[start:start + chunk_size] for group in groups
+            for start in range(0, len(group), chunk_size)]
+
+
+def _init_worker(properties):
+    global _base_properties
+    _base_properties = properties
+
+
+def _get_error(error):
+    return {'error': '{}: {}'.format(type(error).__name__, error)}
+
+
+def _solve_variants(variants):
+    '''Solves variants that share a distance key in a worker,
+    reusing one matrix and initial solution for all of them.
+    '''
+    key = _get_distance_key(variants[0])
+    try:
+        entry = WarmInstance(Instance(dict(_base_properties, **dict(key))))
+    except Exception as error:
+        return [_get_error(error) for overrides in variants]
+    results = []
+    for overrides in variants:
+        try:
+            entry.instance.override_properties(
+                dict((prop, overrides.get(prop, _base_properties[prop]))
+                     for prop in CAPACITY_PROPERTIES))
+            result = solve_warm(entry)
+        except Exception as error:
+            results.append(_get_error(error))
+            continue
+        del result['solution']
+        results.append(result)
+    return results
+
+
+def sweep(instance: Instance, grid, workers=None):
+    '''Solves every variant of the grid in a process pool.
+    Returns a list of (overrides, result) pairs.
+    '''
+    variants = get_variants(grid)
+    if workers is None:
+        workers = os.cpu_count() or 1
+    tasks = _split_variants(variants, max(1, workers))
+    with ProcessPoolExecutor(max(1, min(workers, len(tasks))),
+                             initializer=_init_worker,
+                             initargs=(instance.get_properties(),)) as executor:
+        results = list(chain.from_iterable(
+            executor.map(_solve_variants, tasks)))
+    return list(zip(variants, results))
@@ -0,0 +1,42 @@
+'''Progress telemetry written as JSON Lines.'''
+import os
+import json
+import time
+
+
+class Telemetry:
+    '''Writes timestamped events to a stream, one JSON object per line.
+    Progress events are throttled to at most one per interval seconds.
+    '''
+
+    @staticmethod
+    def open(target, interval=1.0):
+        '''Open telemetry on a file descriptor number or a file path.'''
+        if target.isdigit():
+            stream = os.fdopen(int(target), 'w', buffering=1, closefd=False)
+        else:
+            stream = open(target, 'w', buffering=1)
+        return Telemetry(stream, interval)
+
+    def __init__(self, stream, interval=1.0):
+        self.stream = stream
+        self.interval = interval
+        self.start_time = time.monotonic()
+        self.last_time = None
+
+    def is_due(self):
+        '''Returns True when a throttled event may be emitted now.'''
+        return self.last_time is None \
+            or time.monotonic() - self.last_time >= self.interval
+
+    def emit(self, event, **fields):
+        '''Write an event regardless of throttling.'''
+        now = time.monotonic()
+        self.last_time = now
+        record = {'event': event, 'elapsed': round(now - self.start_time, 6)}
+        record.update(fields)
+        self.stream.write(json.dumps(record) + '\n')
+
+    def close(self):
+        '''Flush and close the stream.'''
+        self.stream.close()
@@ -0,0 +1,254 @@
+'''Verifies exported solutions against a problem instance.'''
+import evaluator
+from instance import Instance
+from evaluator import EMERGENCY, T_EMPTY_TO_BF, AT_BF, T_BF_TO_FULL_BUFFER, \
+    AT_FULL_BUFFER, T_FULL_TO_DESULF, AT_DESULF, T_DESULF_TO_CONVERTER, \
+    AT_CONVERTER, T_CONVERTER_TO_EMPTY, STATE_COUNT
+
+_STATE_NAMES = [
+    'transit empty buffer to BF',
+    'BF',
+    'transit BF to full buffer',
+    'full buffer',
+    'transit full buffer to desulf',
+    'desulf',
+    'transit desulf to converter',
+    'converter',
+    'transit converter to empty buffer'
+]
+
+_RUN_FIELDS = ['idTorpedo', 'idBF', 'idConverter', 'startBF', 'endBF',
+               'startFullBuffer', 'endFullBuffer', 'startDesulf', 'endDesulf',
+               'startConverter', 'endConverter', 'startEmptyBuffer', 'endEmptyBuffer']
+
+_EMERGENCY_FIELDS = ['idTorpedo', 'idBF', 'idConverter', 'startBF', 'endBF',
+                     'startEmptyBuffer', 'endEmptyBuffer']
+
+
+def parse_solution(lines):
+    '''Parse lines in the print_solution format into the declared
+    torpedo count, a list of run dictionaries and the list of lines
+    that could not be parsed.
+    '''
+    torpedo_count = None
+    runs = []
+    errors = []
+    for line_number, line in enumerate(lines, 1):
+        if '=' not in line:
+            continue
+        key, value = [expr.strip() for expr in line.split('=', 1)]
+        if key != 'nbTorpedoes' and key not in _RUN_FIELDS:
+            continue
+        try:
+            value = int(value)
+        except ValueError:
+            errors.append('Line {}: {} is not an integer: {}'.format(
+                line_number, key, line.strip()))
+            continue
+        if key == 'nbTorpedoes':
+            torpedo_count = value
+        elif key == 'idTorpedo':
+            runs.append({key: value})
+        elif len(runs) > 0:
+            runs[-1][key] = value
+    return torpedo_count, runs, errors
+
+
+def get_run_intervals(instance: Instance, run):
+    '''Returns the (state, start, end) intervals of an exported run.'''
+    start = run['startBF'] - instance.tt_empty_buffer_to_bf
+    if run['idConverter'] == -1:
+        points = [(T_EMPTY_TO_BF, start), (AT_BF, run['startBF']),
+                  (EMERGENCY, run['endBF']), (None, run['startEmptyBuffer'])]
+    else:
+        points = [(T_EMPTY_TO_BF, start),
+                  (AT_BF, run['startBF']),
+                  (T_BF_TO_FULL_BUFFER, run['endBF']),
+                  (AT_FULL_BUFFER, run['startFullBuffer']),
+                  (T_FULL_TO_DESULF, run['endFullBuffer']),
+                  (AT_DESULF, run['startDesulf']),
+                  (T_DESULF_TO_CONVERTER, run['endDesulf']),
+                  (AT_CONVERTER, run['startConverter']),
+                  (T_CONVERTER_TO_EMPTY, run['endConverter']),
+                  (None, run['startEmptyBuffer'])]
+    return [(points[i][0], points[i][1], points[i + 1][1])
+            for i in range(len(points) - 1)]
+
+
+def _check_ids(instance: Instance, runs, errors):
+    '''Check that every run refers to an existing BF and converter.'''
+    bf_count = len(instance.bf_schedules)
+    converter_count = len(instance.converter_schedules)
+    for run in runs:
+        if not 0 <= run['idBF'] < bf_count:
+            errors.append('Torpedo {} has unknown BF {}'.format(
+                run['idTorpedo'], run['idBF']))
+        if run['idConverter'] != -1 \
+                and not 0 <= run['idConverter'] < converter_count:
+            errors.append('Torpedo {} BF {} has unknown converter {}'.format(
+                run['idTorpedo'], run['idBF'], run['idConverter']))
+
+
+def _check_run(instance: Instance, run, errors):
+    '''Check durations, deadlines and sulfur levels of a single run.'''
+    def _error(message, *args):
+        errors.append('Torpedo {} BF {}: '.format(
+            run['idTorpedo'], run['idBF']) + message.format(*args))
+
+    bf = instance.bf_schedules[run['idBF']]
+    if run['startBF'] != bf.time:
+        _error('starts at BF at {}, expected {}', run['startBF'], bf.time)
+    if run['endBF'] - run['startBF'] != instance.dur_bf:
+        _error('stays at BF for {}, expected {}',
+               run['endBF'] - run['startBF'], instance.dur_bf)
+
+    if run['idConverter'] == -1:
+        min_end = run['endBF'] + instance.tt_bf_emergency_pit_empty_buffer
+        if run['startEmptyBuffer'] < min_end:
+            _error('returns from emergency pit at {}, earliest is {}',
+                   run['startEmptyBuffer'], min_end)
+        return 0
+
+    converter = instance.converter_schedules[run['idConverter']]
+    transits = [
+        ('endBF', 'startFullBuffer', instance.tt_bf_to_full_buffer),
+        ('endFullBuffer', 'startDesulf', instance.tt_full_buffer_to_desulf),
+        ('endDesulf', 'startConverter', instance.tt_desulf_to_converter),
+        ('endConverter', 'startEmptyBuffer',
+         instance.tt_converter_to_empty_buffer)
+    ]
+    for start_field, end_field, duration in transits:
+        if run[end_field] - run[start_field] < duration:
+            _error('{} is {}, earliest is {}', end_field, run[end_field],
+                   run[start_field] + duration)
+    for start_field, end_field in [('startFullBuffer', 'endFullBuffer'),
+                                   ('startDesulf', 'endDesulf')]:
+        if run[end_field] < run[start_field]:
+            _error('{} is before {}', end_field, start_field)
+
+    if run['startConverter'] > converter.time:
+        _error('reaches converter {} at {}, deadline is {}',
+               converter.converter_id, run['startConverter'], converter.time)
+    if run['endConverter'] < converter.time + instance.dur_converter:
+        _error('leaves converter {} at {}, earliest is {}',
+               converter.converter_id, run['endConverter'],
+               converter.time + instance.dur_converter)
+
+    desulf_duration = run['endDesulf'] - run['startDesulf']
+    steps = bf.sulf_level if instance.dur_desulf == 0 \
+        else max(0, desulf_duration // instance.dur_desulf)
+    if bf.sulf_level - steps > converter.max_sulf_level:
+        _error('sulfur level {} after desulf exceeds {} at converter {}',
+               bf.sulf_level - steps, converter.max_sulf_level,
+               converter.converter_id)
+    return desulf_duration
+
+
+def _check_assignment(instance: Instance, runs, errors):
+    '''Check that every BF and converter is served exactly once.'''
+    bf_runs = [0 for bf in instance.bf_schedules]
+    converter_runs = [0 for converter in instance.converter_schedules]
+    for run in runs:
+        bf_runs[run['idBF']] += 1
+        if run['idConverter'] != -1:
+            converter_runs[run['idConverter']] += 1
+    for bf_id, count in enumerate(bf_runs):
+        if count != 1:
+            errors.append('BF {} is served {} times'.format(bf_id, count))
+    for converter_id, count in enumerate(converter_runs):
+        if count != 1:
+            errors.append('Converter {} is served {} times'.format(
+                converter_id, count))
+
+
+def _check_torpedo_reuse(instance: Instance, runs, errors):
+    '''Check that runs of the same torpedo do not overlap.'''
+    previous_runs = dict()
+    for run in sorted(runs, key=lambda run: (run['idTorpedo'], run['startBF'])):
+        previous = previous_runs.get(run['idTorpedo'])
+        previous_runs[run['idTorpedo']] = run
+        if previous is None:
+            continue
+        start = run['startBF'] - instance.tt_empty_buffer_to_bf
+        if previous['endEmptyBuffer'] < previous['startEmptyBuffer']:
+            errors.append('Torpedo {} BF {}: endEmptyBuffer is before '
+                          'startEmptyBuffer'.format(previous['idTorpedo'],
+                                                    previous['idBF']))
+        elif previous['endEmptyBuffer'] > start:
+            errors.append('Torpedo {} must leave empty buffer at {} for BF {}, '
+                          'but its run for BF {} leaves it at {}'.format(
+                              run['idTorpedo'], start, run['idBF'],
+                              previous['idBF'], previous['endEmptyBuffer']))
+
+
+def _check_capacities(instance: Instance, runs, errors):
+    '''Sweep over run intervals and check every state capacity.
+    Returns the peak number of torpedoes in use at the same time.
+    '''
+    max_states = evaluator.get_state_constraints(instance)
+    events = []
+    for run in runs:
+        intervals = get_run_intervals(instance, run)
+        for state, start, end in intervals:
+            if end > start and state != EMERGENCY:
+                events.append((start, 1, state))
+                events.append((end, -1, state))
+        events.append((intervals[0][1], 1, STATE_COUNT))
+        events.append((intervals[-1][2], -1, STATE_COUNT))
+
+    # Departures sort before arrivals in the same slot.
+    events.sort()
+    counts = [0 for state in range(STATE_COUNT)]
+    violation_start = [None for state in range(STATE_COUNT)]
+    torpedoes = 0
+    peak_torpedoes = 0
+    for time, delta, state in events:
+        if state == STATE_COUNT:
+            torpedoes += delta
+            peak_torpedoes = max(peak_torpedoes, torpedoes)
+            continue
+        counts[state] += delta
+        if counts[state] > max_states[state]:
+            if violation_start[state] is None:
+                violation_start[state] = time
+        elif violation_start[state] is not None:
+            errors.append('Capacity {} of {} exceeded from {} to {}'.format(
+                max_states[state], _STATE_NAMES[state],
+                violation_start[state], time))
+            violation_start[state] = None
+    return peak_torpedoes
+
+
+def verify_solution(instance: Instance, torpedo_count, runs):
+    '''Check every constraint of an exported solution.
+    Returns the list of violations, the peak torpedo count,
+    the total desulf time and the cost of the solution.
+    '''
+    errors = []
+    for run in runs:
+        fields = _EMERGENCY_FIELDS if run.get('idConverter') == -1 \
+            else _RUN_FIELDS
+        missing = [field for field in fields if field not in run]
+        if len(missing) > 0:
+            errors.append('Run for BF {} is missing {}'.format(
+                run.get('idBF'), ', '.join(missing)))
+            return errors, 0, 0, 0
+    _check_ids(instance, runs, errors)
+    if len(errors) > 0:
+        return errors, 0, 0, 0
+
+    desulf_time = 0
+    for run in runs:
+        desulf_time += _check_run(instance, run, errors)
+    _check_assignment(instance, runs, errors)
+    _check_torpedo_reuse(instance, runs, errors)
+    peak_torpedoes = _check_capacities(instance, runs, errors)
+
+    torpedo_ids = set(run['idTorpedo'] for run in runs)
+    if torpedo_count is None:
+        torpedo_count = len(torpedo_ids)
+    elif torpedo_count < len(torpedo_ids):
+        errors.append('nbTorpedoes={} but {} torpedoes are used'.format(
+            torpedo_count, len(torpedo_ids)))
+    cost = evaluator.evaluate_solution(instance, torpedo_count, desulf_time)
+    return errors, peak_torpedoes, desulf_time, cost